@@ -1,7 +1,13 @@
 # coding=utf-8
+import gzip
 import json
 import logging
+import os
+import re
+import threading
+import time
 import traceback
+from urllib.parse import urlparse
 
 import dateutil.parser
 
@@ -9,18 +15,36 @@ from pysqlite3 import dbapi2 as sqlite3
 from marblecutter import get_zoom
 from marblecutter.catalogs import WGS84_CRS, Catalog
 from marblecutter.utils import Bounds, Source
+from cachetools import LRUCache
 from rasterio import warp
 
+from .recipes import compile_source
+
 Infinity = float("inf")
 LOG = logging.getLogger(__name__)
+COPY_ESCAPES = {"b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t", "v": "\v"}
+
+
+def localize(url, root):
+    """Map a remote source URL onto a local mirror, e.g. s3://bucket/key -> {root}/bucket/key."""
+    parsed = urlparse(url)
+
+    if parsed.scheme in ("", "file"):
+        return url
+
+    return os.path.join(root, parsed.netloc, parsed.path.lstrip("/"))
 
 
 class SpatialiteCatalog(Catalog):
     def __init__(self):
-        self.conn = sqlite3.connect(":memory:")
+        # connections are shared between threads (callers serialize access using lock)
+        self.conn = sqlite3.connect(":memory:", check_same_thread=False)
+        self.lock = threading.Lock()
         # self.conn = sqlite3.connect("/tmp/catalog.sqlite3")
         self.conn.enable_load_extension(True)
         self.conn.execute("SELECT load_extension('mod_spatialite')")
+        # decoded band_info, meta, and recipes, keyed by rowid
+        self.blobs = {}
 
         cursor = self.conn.cursor()
 
@@ -123,7 +147,293 @@ INSERT INTO footprints (
         finally:
             cursor.close()
 
+        # compile lookup tables once, rather than per tile
+        compile_source(source)
+
+    def load_dump(self, path, table="land_cover"):
+        """Load enabled footprints from a pg_dump (optionally gzipped) of a catalog table."""
+        opener = gzip.open if path.endswith(".gz") else open
+        columns = None
+        count = 0
+
+        def unescape(value):
+            if value == "\\N":
+                return None
+
+            return re.sub(
+                r"\\(.)", lambda m: COPY_ESCAPES.get(m.group(1), m.group(1)), value
+            )
+
+        cursor = self.conn.cursor()
+
+        try:
+            with opener(path, "rt", encoding="utf-8") as dump:
+                for line in dump:
+                    line = line.rstrip("\n")
+
+                    if columns is None:
+                        match = re.match(
+                            r"COPY (?:\w+\.)?{} \((.+)\) FROM stdin;".format(table), line
+                        )
+
+                        if match:
+                            columns = [c.strip() for c in match.group(1).split(",")]
+
+                        continue
+
+                    if line == "\\.":
+                        break
+
+                    row = dict(zip(columns, map(unescape, line.split("\t"))))
+
+                    if row.get("enabled", "t") != "t":
+                        continue
+
+                    cursor.execute(
+                        """
+INSERT INTO footprints (
+  source,
+  filename,
+  url,
+  resolution,
+  min_zoom,
+  max_zoom,
+  priority,
+  meta,
+  recipes,
+  band_info,
+  acquired_at,
+  geom,
+  mask
+) VALUES (
+  ?,
+  ?,
+  ?,
+  ?,
+  ?,
+  ?,
+  ?,
+  ?,
+  ?,
+  ?,
+  date(?),
+  CastToMultiPolygon(GeomFromEWKB(?)),
+  CastToMultiPolygon(GeomFromEWKB(?))
+)
+      """,
+                        (
+                            row["source"],
+                            row["filename"],
+                            row["url"],
+                            row["resolution"],
+                            row["min_zoom"],
+                            row["max_zoom"],
+                            row["priority"],
+                            row["meta"],
+                            row["recipes"],
+                            row["bands"],
+                            row["acquired_at"],
+                            row["geom"],
+                            row["mask"],
+                        ),
+                    )
+                    count += 1
+
+            self.conn.commit()
+        except Exception as e:
+            LOG.exception(e)
+            raise e
+        finally:
+            cursor.close()
+
+        LOG.info("Loaded %d footprints from %s", count, path)
+
+        for source in self.registry().values():
+            compile_source(source)
+
+    def load_snapshot(self, path):
+        """Replace this catalog's contents with a snapshot (see save)."""
+        snapshot = sqlite3.connect(path)
+
+        try:
+            snapshot.backup(self.conn)
+        finally:
+            snapshot.close()
+
+        self.blobs = {}
+
+        for source in self.registry().values():
+            compile_source(source)
+
+    def save(self, path):
+        """Save a snapshot of this catalog."""
+        snapshot = sqlite3.connect(path)
+
+        try:
+            self.conn.backup(snapshot)
+        finally:
+            snapshot.close()
+
+    def extents(self):
+        """Get WGS84 bounding boxes of every source's footprint, keyed by source URL."""
+        cursor = self.conn.cursor()
+
+        try:
+            cursor.execute(
+                """
+SELECT
+  url,
+  MbrMinX(geom),
+  MbrMinY(geom),
+  MbrMaxX(geom),
+  MbrMaxY(geom)
+FROM footprints
+      """
+            )
+
+            return {url: tuple(bbox) for url, *bbox in cursor}
+        finally:
+            cursor.close()
+
+    def metadata(self):
+        """Get the bounds and zoom range of all footprints: ([w, s, e, n], min_zoom, max_zoom)."""
+        cursor = self.conn.cursor()
+
+        try:
+            cursor.execute(
+                """
+SELECT
+  MbrMinX(Extent(geom)),
+  MbrMinY(Extent(geom)),
+  MbrMaxX(Extent(geom)),
+  MbrMaxY(Extent(geom)),
+  min(min_zoom),
+  max(max_zoom)
+FROM footprints
+      """
+            )
+            *bounds, min_zoom, max_zoom = cursor.fetchone()
+
+            return bounds, min_zoom, max_zoom
+        finally:
+            cursor.close()
+
+    def registry(self):
+        """Decode every source once, keyed by a compact id (see get_source_ids)."""
+        cursor = self.conn.cursor()
+
+        try:
+            cursor.execute(
+                """
+SELECT
+  rowid,
+  url,
+  source,
+  resolution,
+  coalesce(band_info, '{}') band_info,
+  coalesce(meta, '{}') meta,
+  coalesce(recipes, '{}') recipes,
+  acquired_at,
+  priority,
+  AsGeoJSON(mask) mask
+FROM footprints
+      """
+            )
+
+            sources = {}
+            for record in cursor:
+                (
+                    id,
+                    url,
+                    source,
+                    res,
+                    band_info,
+                    meta,
+                    recipes,
+                    acquired_at,
+                    priority,
+                    mask,
+                ) = record
+
+                if mask is not None:
+                    mask = json.loads(mask)
+
+                sources[id] = Source(
+                    url,
+                    source,
+                    res,
+                    json.loads(band_info),
+                    json.loads(meta),
+                    json.loads(recipes),
+                    acquired_at,
+                    None,
+                    priority,
+                    None,
+                    mask=mask,
+                )
+
+            return sources
+        except Exception as e:
+            LOG.exception(e)
+            raise e
+        finally:
+            cursor.close()
+
     def get_sources(self, bounds, resolution):
+        for record in self._query(bounds, resolution):
+            (
+                id,
+                url,
+                source,
+                res,
+                band_info,
+                meta,
+                recipes,
+                acquired_at,
+                band,
+                priority,
+                coverage,
+                _,
+                mask,
+                _,
+            ) = record
+
+            if mask is not None:
+                mask = json.loads(mask)
+
+            if id not in self.blobs:
+                self.blobs[id] = (
+                    json.loads(band_info),
+                    json.loads(meta),
+                    json.loads(recipes),
+                )
+
+            band_info, meta, recipes = self.blobs[id]
+
+            yield Source(
+                url,
+                source,
+                res,
+                band_info,
+                meta,
+                recipes,
+                acquired_at,
+                band,
+                priority,
+                coverage,
+                mask=mask,
+            )
+
+    def get_source_ids(self, bounds, resolution):
+        """Like get_sources, but yielding ids of sources in the registry.
+
+        Geometries, masks, and coverage aren't serialized (ids are resolved
+        against the registry, which holds unclipped masks).
+        """
+        for record in self._query(bounds, resolution, geometries=False):
+            yield record[0]
+
+    def _query(self, bounds, resolution, geometries=True):
         cursor = self.conn.cursor()
 
         # TODO this is becoming relatively standard catalog boilerplate
@@ -155,6 +465,7 @@ date_range AS (
   FROM footprints
 )
 SELECT
+  footprints.rowid,
   url,
   source,
   resolution,
@@ -164,11 +475,10 @@ SELECT
   acquired_at,
   null band, -- for Source constructor compatibility
   priority,
-  ST_Area(ST_Intersection(uncovered.geom, ST_Difference(footprints.geom, footprints.mask))) /
-  ST_Area(bbox.geom) coverage,
-  AsGeoJSON(ST_Intersection(bbox.geom, footprints.geom)) geom,
-  AsGeoJSON(ST_Intersection(footprints.mask, bbox.geom)) mask,
-  AsGeoJSON(ST_Difference(uncovered.geom, ST_Difference(footprints.geom, footprints.mask))) uncovered
+  {coverage} coverage,
+  {geom} geom,
+  {mask} mask,
+  AsGeoJSON(ST_Difference(uncovered.geom, COALESCE(ST_Difference(footprints.geom, footprints.mask), footprints.geom))) uncovered
 FROM bbox, date_range, footprints
 JOIN uncovered ON ST_Intersects(footprints.geom, uncovered.geom)
 WHERE footprints.source || ' - ' || footprints.url NOT IN ({id_placeholders})
@@ -205,51 +515,31 @@ LIMIT 1
                 }
             )
 
+            if geometries:
+                columns = {
+                    "coverage": "ST_Area(ST_Intersection(uncovered.geom, COALESCE(ST_Difference(footprints.geom, footprints.mask), footprints.geom))) / ST_Area(bbox.geom)",
+                    "geom": "AsGeoJSON(ST_Intersection(bbox.geom, footprints.geom))",
+                    "mask": "AsGeoJSON(ST_Intersection(footprints.mask, bbox.geom))",
+                }
+            else:
+                columns = {"coverage": "NULL", "geom": "NULL", "mask": "NULL"}
+
             uncovered = bbox
             ids = set()
 
             while True:
                 id_placeholders = ", ".join("?" * len(ids))
                 cursor.execute(
-                    query.format(id_placeholders=id_placeholders),
+                    query.format(id_placeholders=id_placeholders, **columns),
                     (bbox, uncovered) + tuple(ids) + (zoom, min(resolution)),
                 )
 
                 count = 0
                 for record in cursor:
                     count += 1
-                    (
-                        url,
-                        source,
-                        res,
-                        band_info,
-                        meta,
-                        recipes,
-                        acquired_at,
-                        band,
-                        priority,
-                        coverage,
-                        _,
-                        mask,
-                        uncovered,
-                    ) = record
-
-                    if mask is not None:
-                        mask = json.loads(mask)
-
-                    yield Source(
-                        url,
-                        source,
-                        res,
-                        json.loads(band_info),
-                        json.loads(meta),
-                        json.loads(recipes),
-                        acquired_at,
-                        band,
-                        priority,
-                        coverage,
-                        mask=mask,
-                    )
+                    url, source, uncovered = record[1], record[2], record[-1]
+
+                    yield record
 
                     ids.add(source + " - " + url)
 
@@ -260,3 +550,110 @@ LIMIT 1
             LOG.exception(e)
         finally:
             cursor.close()
+
+
+class FileCatalog(Catalog):
+    """An embedded catalog, loaded from a pg_dump or Spatialite snapshot.
+
+    The file is checked for changes (at most every `check_interval` seconds)
+    and reloaded when it's modified. When `source_root` is set, sources are
+    read from a local mirror of their URLs (see localize).
+    """
+
+    def __init__(self, path, check_interval=60, source_root=None, name="land_cover"):
+        self._name = name
+        self.path = path
+        self.check_interval = check_interval
+        self.source_root = source_root
+        self.cache = LRUCache(maxsize=4096)
+        self.lock = threading.Lock()
+        self.reloading = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._load()
+
+    def _load(self):
+        mtime = os.stat(self.path).st_mtime
+        catalog = SpatialiteCatalog()
+
+        if self.path.endswith((".sqlite", ".sqlite3", ".db")):
+            catalog.load_snapshot(self.path)
+        else:
+            catalog.load_dump(self.path)
+
+        bounds, min_zoom, max_zoom = catalog.metadata()
+
+        # swap the new catalog in (and clear cached results)
+        with self.lock:
+            self.catalog = catalog
+            self.cache = LRUCache(maxsize=self.cache.maxsize)
+
+            if None not in bounds:
+                self._bounds = bounds
+                self._center = [
+                    (bounds[0] + bounds[2]) / 2,
+                    (bounds[1] + bounds[3]) / 2,
+                    min_zoom,
+                ]
+
+            if min_zoom is not None:
+                self._minzoom = min_zoom
+                self._maxzoom = max_zoom
+
+        self.mtime = mtime
+        self.checked_at = time.time()
+
+    def _check(self):
+        now = time.time()
+
+        if now - self.checked_at < self.check_interval:
+            return
+
+        # only one thread checks (and reloads); others continue using the
+        # current catalog in the meantime
+        if not self.reloading.acquire(blocking=False):
+            return
+
+        try:
+            if now - self.checked_at < self.check_interval:
+                return
+
+            self.checked_at = now
+
+            if os.stat(self.path).st_mtime != self.mtime:
+                LOG.info("%s changed; reloading", self.path)
+                self._load()
+        except Exception as e:
+            LOG.exception(e)
+        finally:
+            self.reloading.release()
+
+    def get_sources(self, bounds, resolution):
+        self._check()
+
+        key = (tuple(bounds.bounds), str(bounds.crs), tuple(resolution))
+
+        with self.lock:
+            # results are cached alongside the catalog they came from
+            catalog = self.catalog
+            cache = self.cache
+            sources = cache.get(key)
+
+            if sources is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if sources is None:
+            with catalog.lock:
+                sources = list(catalog.get_sources(bounds, resolution))
+
+            if self.source_root is not None:
+                sources = [
+                    s._replace(url=localize(s.url, self.source_root)) for s in sources
+                ]
+
+            with self.lock:
+                cache[key] = sources
+
+        return iter(sources)
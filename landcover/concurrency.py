@@ -0,0 +1,137 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import logging
+import threading
+from concurrent import futures
+
+LOG = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    pass
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Coalesce concurrent calls sharing a key into a single call.
+
+    (threading primitives are cooperative when gevent has monkey-patched them.)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.hits = 0
+        self.misses = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+
+            if leader:
+                call = self.calls[key] = _Call()
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if not leader:
+            call.done.wait()
+
+            if call.error is not None:
+                raise call.error
+
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        except BaseException as e:
+            # e.g. GreenletExit; followers get an ordinary error rather than
+            # a missing result (and aren't killed themselves)
+            call.error = Exception("Coalesced call was interrupted: {!r}".format(e))
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+            call.done.set()
+
+
+def _thread_pool(size):
+    try:
+        from gevent import monkey
+
+        if monkey.is_module_patched("threading"):
+            # patched threads are greenlets; use real threads that greenlets can
+            # wait on without blocking the event loop
+            from gevent.threadpool import ThreadPool
+
+            return ThreadPool(size).apply
+    except ImportError:
+        pass
+
+    executor = futures.ThreadPoolExecutor(max_workers=size)
+
+    return lambda fn, args, kwargs: executor.submit(fn, *args, **kwargs).result()
+
+
+class RenderPool(object):
+    """A bounded pool for CPU-heavy rendering that sheds load when it's backed up.
+
+    Calls block (cooperatively, under gevent) until complete; once
+    `max_pending` calls are running or waiting, further calls fail immediately
+    with Overloaded.
+    """
+
+    def __init__(self, size, max_pending):
+        self.size = size
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.rejected = 0
+        self._apply = None
+
+    def reserve(self):
+        """Reserve a slot for a call (see apply_reserved), failing with Overloaded if none remain."""
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise Overloaded(
+                    "{} renders pending (limit: {})".format(
+                        self.pending, self.max_pending
+                    )
+                )
+
+            self.pending += 1
+
+            if self._apply is None:
+                # create threads lazily, in the process that will use them
+                self._apply = _thread_pool(self.size)
+
+    def release(self):
+        with self.lock:
+            self.pending -= 1
+
+    def apply_reserved(self, fn, *args, **kwargs):
+        """Make a call using a previously reserved slot."""
+        try:
+            return self._apply(fn, args, kwargs)
+        finally:
+            self.release()
+
+    def apply(self, fn, *args, **kwargs):
+        self.reserve()
+
+        return self.apply_reserved(fn, *args, **kwargs)
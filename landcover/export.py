@@ -0,0 +1,187 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import logging
+import math
+import os
+import tempfile
+from concurrent import futures
+from urllib.parse import urlparse
+
+import numpy as np
+import rasterio
+import rasterio.shutil
+from marblecutter import NoDataAvailable, render
+from marblecutter.catalogs import WGS84_CRS
+from marblecutter.utils import Bounds
+from rasterio import windows, warp
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+
+from .colormap import COLORMAP
+from .formats import Raw
+from .storage import S3
+
+LOG = logging.getLogger(__name__)
+
+NODATA = 255
+RAW_FORMAT = Raw()
+# circumference of the earth (in meters) / 256 pixels
+ZOOM_0_RESOLUTION = 2 * math.pi * 6378137 / 256
+
+
+def resolution_for_zoom(zoom):
+    return ZOOM_0_RESOLUTION / 2 ** zoom
+
+
+def generate_windows(width, height, size):
+    for row_off in range(0, height, size):
+        for col_off in range(0, width, size):
+            yield windows.Window(
+                col_off, row_off, min(size, width - col_off), min(size, height - row_off)
+            )
+
+
+def export(
+    catalog,
+    bounds,
+    target,
+    crs="EPSG:3857",
+    resolution=None,
+    zoom=None,
+    block_size=512,
+    window_size=2048,
+    concurrency=4,
+    max_pixels=None,
+):
+    """Mosaic catalog sources within WGS84 bounds into a single paletted COG.
+
+    Windows are rendered (up to `concurrency` at a time) and written to a
+    tiled GeoTIFF as they complete, so memory is bounded by the window size.
+    Overviews are built using the mode of each class and the result is
+    rewritten as a cloud-optimized GeoTIFF.
+
+    `resolution` is in units of the target CRS; `zoom` may be provided
+    instead for CRSs in meters.
+    """
+    crs = CRS.from_user_input(crs)
+
+    if resolution is None:
+        if zoom is None:
+            raise Exception("Either resolution or zoom must be provided")
+
+        resolution = resolution_for_zoom(zoom)
+
+    left, bottom, right, top = warp.transform_bounds(WGS84_CRS, crs, *bounds)
+    width = int(math.ceil((right - left) / resolution))
+    height = int(math.ceil((top - bottom) / resolution))
+
+    if max_pixels is not None and width * height > max_pixels:
+        raise Exception(
+            "{}x{} exceeds the maximum export size ({} pixels)".format(
+                width, height, max_pixels
+            )
+        )
+
+    transform = from_origin(left, top, resolution, resolution)
+    window_size = max(block_size, window_size - window_size % block_size)
+
+    profile = {
+        "driver": "GTiff",
+        "width": width,
+        "height": height,
+        "count": 1,
+        "dtype": "uint8",
+        "crs": crs,
+        "transform": transform,
+        "nodata": NODATA,
+        "tiled": True,
+        "blockxsize": block_size,
+        "blockysize": block_size,
+        "compress": "deflate",
+        "BIGTIFF": "IF_SAFER",
+    }
+
+    def _render(window):
+        window_bounds = Bounds(windows.bounds(window, transform), crs)
+        shape = (int(window.height), int(window.width))
+
+        try:
+            _, pixels = render(
+                window_bounds, shape, crs, format=RAW_FORMAT, catalog=catalog
+            )
+        except NoDataAvailable:
+            return window, None
+
+        return window, np.ma.filled(pixels[0], NODATA).astype(np.uint8)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "mosaic.tif")
+
+        LOG.info("Rendering %dx%d pixels to %s", width, height, path)
+
+        with rasterio.open(path, "w", **profile) as dst:
+            dst.write_colormap(1, COLORMAP)
+
+            with futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+                pending = set()
+
+                def write(done):
+                    for future in done:
+                        window, data = future.result()
+
+                        if data is not None:
+                            dst.write(data, 1, window=window)
+
+                for window in generate_windows(width, height, window_size):
+                    # bound the number of windows in memory
+                    if len(pending) >= concurrency * 2:
+                        done, pending = futures.wait(
+                            pending, return_when=futures.FIRST_COMPLETED
+                        )
+                        write(done)
+
+                    pending.add(executor.submit(_render, window))
+
+                write(futures.as_completed(pending))
+
+            factors = []
+            factor = 2
+            while max(width, height) / factor >= block_size / 2:
+                factors.append(factor)
+                factor *= 2
+
+            LOG.info("Building overviews: %s", factors)
+            dst.build_overviews(factors, Resampling.mode)
+            dst.update_tags(ns="rio_overview", resampling="mode")
+
+        url = urlparse(target)
+
+        if url.scheme == "s3":
+            output = os.path.join(tmp, "cog.tif")
+        else:
+            output = os.path.abspath(url.netloc + url.path)
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+
+        rasterio.shutil.copy(
+            path,
+            output,
+            driver="GTiff",
+            copy_src_overviews=True,
+            tiled=True,
+            blockxsize=block_size,
+            blockysize=block_size,
+            compress="deflate",
+            BIGTIFF="IF_SAFER",
+        )
+
+        if url.scheme == "s3":
+            S3.upload_file(
+                output,
+                url.netloc,
+                url.path[1:],
+                ExtraArgs={"ContentType": "image/tiff"},
+            )
+
+    return target
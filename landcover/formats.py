@@ -10,6 +10,9 @@ import rasterio
 from rasterio import features, transform, warp
 from rasterio.crs import CRS
 from rasterio.rio.helpers import coords
+from shapely.geometry import MultiPolygon, box, mapping, shape
+
+from .stats import class_areas
 
 logger = logging.getLogger(__name__)
 
@@ -31,23 +34,120 @@ def reproject(shapes, bounds):
             }
 
 
+def vectorize(pixels, sieve_size=4):
+    _, width, height = pixels.data.shape
+    t = transform.from_bounds(*pixels.bounds.bounds, width, height)
+
+    sieved = features.sieve(pixels.data[0], sieve_size)
+
+    # shapes = features.shapes(pixels.data.data, transform=t)
+    shapes = features.shapes(sieved, transform=t)
+
+    return list(reproject(shapes, pixels.bounds))
+
+
 def GeoJSON(sieve_size=4):
     def _format(pixels, data_format, sources):
         if data_format != "raw":
             raise Exception("Must be raw-formatted")
 
-        _, width, height = pixels.data.shape
-        t = transform.from_bounds(*pixels.bounds.bounds, width, height)
+        fs = vectorize(pixels, sieve_size)
 
-        sieved = features.sieve(pixels.data[0], sieve_size)
+        fc = {"type": "FeatureCollection", "features": fs}
 
-        # shapes = features.shapes(pixels.data.data, transform=t)
-        shapes = features.shapes(sieved, transform=t)
+        return ("application/json", json.dumps(fc))
 
-        fs = list(reproject(shapes, pixels.bounds))
+    return _format
 
-        fc = {"type": "FeatureCollection", "features": fs}
 
-        return ("application/json", json.dumps(fc))
+def Raw():
+    """Pass pixels through (as a masked array), for further processing."""
+
+    def _format(pixels, data_format, sources):
+        return ("application/octet-stream", pixels.data)
+
+    return _format
+
+
+def Summary(geometry=None):
+    """Summarize areas (in m²) of each class, optionally within a (Web Mercator) geometry."""
+
+    def _format(pixels, data_format, sources):
+        data = pixels.data[0]
+        mask = None
+
+        if geometry is not None:
+            height, width = data.shape
+            t = transform.from_bounds(*pixels.bounds.bounds, width, height)
+            mask = features.geometry_mask(
+                [geometry], (height, width), t, invert=True
+            )
+
+        return (
+            "application/json",
+            json.dumps(class_areas(data, pixels.bounds.bounds, mask)),
+        )
 
     return _format
+
+
+def clip_geometry(geometry, bounds):
+    """Intersect a (Multi)Polygon with a bounding box, returning a GeoJSON geometry (or None)."""
+    g = shape(geometry)
+
+    if not g.is_valid:
+        # reprojection can introduce self-intersections
+        g = g.buffer(0)
+
+    clipped = g.intersection(box(*bounds))
+
+    # intersections may include lines or points where polygons touch the box
+    polygons = [
+        p
+        for part in getattr(clipped, "geoms", [clipped])
+        for p in getattr(part, "geoms", [part])
+        if p.geom_type == "Polygon" and not p.is_empty
+    ]
+
+    if not polygons:
+        return None
+
+    if len(polygons) == 1:
+        return mapping(polygons[0])
+
+    return mapping(MultiPolygon(polygons))
+
+
+def clip(fs, bounds):
+    """Clip features to a bounding box, dropping those that fall outside it."""
+    min_x, min_y, max_x, max_y = bounds
+
+    for f in fs:
+        f_min_x, f_min_y, f_max_x, f_max_y = f["bbox"]
+
+        if f_min_x > max_x or f_max_x < min_x or f_min_y > max_y or f_max_y < min_y:
+            continue
+
+        if f_min_x >= min_x and f_max_x <= max_x and f_min_y >= min_y and f_max_y <= max_y:
+            yield f
+            continue
+
+        g = f["geometry"]
+
+        if g["type"] not in ("Polygon", "MultiPolygon"):
+            logger.warning("Unable to clip %s geometries", g["type"])
+            continue
+
+        g = clip_geometry(g, bounds)
+
+        if g is None:
+            continue
+
+        xs, ys = zip(*coords(g))
+
+        yield {
+            "type": "Feature",
+            "properties": f["properties"],
+            "bbox": [min(xs), min(ys), max(xs), max(ys)],
+            "geometry": g,
+        }
@@ -0,0 +1,172 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import logging
+from collections import defaultdict
+
+import mercantile
+import numpy as np
+import rasterio
+from marblecutter import get_resolution_in_meters
+from marblecutter.tiling import WEB_MERCATOR_CRS
+from marblecutter.utils import Bounds
+from rasterio import features, warp
+from rasterio.transform import rowcol
+from rasterio.windows import Window
+
+from .recipes import compile_source
+from .stats import CLASSES, MAX_LATITUDE
+
+LOG = logging.getLogger(__name__)
+
+
+def sample(source, lons, lats, masks=None):
+    """Sample raw values from a source at lon/lat points, reading each block once.
+
+    Returns values and a mask of points where the source has data (and isn't
+    masked by any of `masks`).
+    """
+    values = np.zeros(len(lons), dtype=np.int64)
+    valid = np.zeros(len(lons), dtype=bool)
+
+    with rasterio.open(source.url) as src:
+        xs, ys = warp.transform("EPSG:4326", src.crs, lons.tolist(), lats.tolist())
+        rows, cols = map(np.asarray, rowcol(src.transform, xs, ys))
+
+        # points on the right / bottom edges (e.g. lon 180, lat -90) belong to
+        # the last column / row, not one past it
+        xs, ys = np.asarray(xs), np.asarray(ys)
+        cols[(cols == src.width) & (xs <= src.bounds.right)] = src.width - 1
+        rows[(rows == src.height) & (ys >= src.bounds.bottom)] = src.height - 1
+
+        inside = (rows >= 0) & (rows < src.height) & (cols >= 0) & (cols < src.width)
+        block_height, block_width = src.block_shapes[0]
+        blocks_across = -(-src.width // block_width)
+
+        masks = [warp.transform_geom("EPSG:4326", src.crs, m) for m in masks or []]
+
+        nodata = src.nodata
+        if nodata is None:
+            nodata = (source.meta or {}).get("nodata")
+
+        keys = (rows // block_height) * blocks_across + cols // block_width
+        keys[~inside] = -1
+
+        for key in np.unique(keys[inside]):
+            idx = np.flatnonzero(keys == key)
+            window = Window(
+                (key % blocks_across) * block_width,
+                (key // blocks_across) * block_height,
+                block_width,
+                block_height,
+            ).intersection(Window(0, 0, src.width, src.height))
+
+            data = src.read(1, window=window)
+            r = rows[idx] - int(window.row_off)
+            c = cols[idx] - int(window.col_off)
+
+            ok = np.ones(len(idx), dtype=bool)
+            if nodata is not None:
+                ok &= data[r, c] != nodata
+
+            if masks:
+                masked = features.geometry_mask(
+                    masks,
+                    data.shape,
+                    src.window_transform(window),
+                    invert=True,
+                    all_touched=True,
+                )
+                ok &= ~masked[r, c]
+
+            values[idx] = data[r, c]
+            valid[idx] = ok
+
+    return values, valid
+
+
+def lookup(catalog, points, zoom):
+    """Look up raw and unified land cover classes at lon/lat points.
+
+    Sources are selected by the catalog for the zoom `zoom` tile containing
+    each point and consulted in priority order; points fall through to the
+    next source where a source has no data (or is masked), matching how
+    tiles are composited. Within each pass, points are grouped by source and
+    by the source's internal blocks so that each block is read once.
+    """
+    lons = np.array([p[0] for p in points], dtype=np.float64)
+    lats = np.array([p[1] for p in points], dtype=np.float64)
+    n = len(points)
+
+    raw = [None] * n
+    classes = [None] * n
+    names = [None] * n
+
+    by_tile = defaultdict(list)
+    for i, (lon, lat) in enumerate(zip(lons, lats)):
+        # select sources using the nearest tile within Web Mercator's bounds
+        tile = mercantile.tile(
+            min(lon, 180 - 1e-9), max(-MAX_LATITUDE, min(MAX_LATITUDE, lat)), zoom
+        )
+        by_tile[tile].append(i)
+
+    # sources for each tile, in priority order
+    candidates = {}
+    for tile in by_tile:
+        bounds = Bounds(mercantile.xy_bounds(tile), WEB_MERCATOR_CRS)
+        resolution = get_resolution_in_meters(bounds, (256, 256))
+        candidates[tile] = list(catalog.get_sources(bounds, resolution))
+
+    depth = 0
+    while by_tile:
+        by_source = defaultdict(list)
+        sources = {}
+        # masks are clipped to each tile, so collect them from every tile
+        masks = defaultdict(list)
+
+        for tile, idx in by_tile.items():
+            if depth < len(candidates[tile]):
+                source = candidates[tile][depth]
+                sources[source.url] = source
+                by_source[source.url].extend(idx)
+
+                if source.mask is not None:
+                    masks[source.url].append(source.mask)
+
+        if not by_source:
+            break
+
+        for url, idx in by_source.items():
+            source = sources[url]
+            idx = np.array(idx)
+
+            try:
+                values, valid = sample(source, lons[idx], lats[idx], masks[url])
+            except Exception as e:
+                LOG.warning("Unable to sample %s: %s", url, e)
+                continue
+
+            remap, _ = compile_source(source)
+
+            for i, value, ok in zip(idx, values, valid):
+                if ok:
+                    raw[i] = int(value)
+                    classes[i] = int(value)
+                    if remap is not None and value < len(remap):
+                        classes[i] = int(remap[value])
+                    names[i] = source.name
+
+        by_tile = {
+            tile: [i for i in idx if raw[i] is None]
+            for tile, idx in by_tile.items()
+            if any(raw[i] is None for i in idx)
+        }
+        depth += 1
+
+    return {
+        "zoom": zoom,
+        "raw": raw,
+        "class": classes,
+        "name": [None if c is None else CLASSES.get(c, str(c)) for c in classes],
+        "source": names,
+    }
@@ -0,0 +1,78 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import ctypes
+import ctypes.util
+import logging
+import os
+
+from cachetools.func import lru_cache
+
+LOG = logging.getLogger(__name__)
+
+
+@lru_cache()
+def _libgdal():
+    # prefer the GDAL rasterio has already loaded (wheels bundle their own)
+    try:
+        with open("/proc/self/maps") as f:
+            for line in f:
+                path = line.split()[-1]
+
+                if os.path.basename(path).startswith("libgdal"):
+                    return _bind(ctypes.CDLL(path))
+    except IOError:
+        pass
+
+    name = ctypes.util.find_library("gdal")
+
+    if name is None:
+        return None
+
+    return _bind(ctypes.CDLL(name))
+
+
+def _bind(lib):
+    for fn in (lib.GDALGetCacheUsed64, lib.GDALGetCacheMax64):
+        fn.argtypes = []
+        fn.restype = ctypes.c_int64
+
+    return lib
+
+
+def gdal_cache():
+    """Get the GDAL block cache's usage and capacity (in bytes), if GDAL can be found."""
+    try:
+        lib = _libgdal()
+    except (AttributeError, OSError) as e:
+        LOG.warning("Unable to load GDAL: %s", e)
+        return None
+
+    if lib is None:
+        return None
+
+    return {"used": lib.GDALGetCacheUsed64(), "max": lib.GDALGetCacheMax64()}
+
+
+def io_counters():
+    """Get this process's read counters from /proc/self/io.
+
+    `storage_bytes` were read from storage (page cache hits excluded);
+    `reads` and `read_bytes` count all read syscalls, including those on
+    client sockets.
+    """
+    counters = {}
+
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                k, v = line.split(":")
+                counters[k] = int(v)
+    except IOError:
+        return None
+
+    return {
+        "reads": counters.get("syscr"),
+        "read_bytes": counters.get("rchar"),
+        "storage_bytes": counters.get("read_bytes"),
+    }
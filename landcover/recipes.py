@@ -0,0 +1,106 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import logging
+
+import numpy as np
+from marblecutter import recipes
+
+LOG = logging.getLogger(__name__)
+
+# compiled lookup tables (and the colormaps they were compiled from), keyed by
+# source URL
+LUTS = {}
+
+_apply = recipes.apply
+
+
+def compile_remap(colormap):
+    """Compile a {value: class} recipe into a dense uint8 lookup table.
+
+    Values without an entry are passed through unchanged.
+    """
+    lut = np.arange(256, dtype=np.uint8)
+
+    for k, v in colormap.items():
+        lut[int(k)] = v
+
+    return lut
+
+
+def compile_palette(colormap):
+    """Compile a {value: [r, g, b]} colormap into a dense (256, 3) uint8 lookup table."""
+    lut = np.zeros((256, 3), dtype=np.uint8)
+
+    for k, v in colormap.items():
+        lut[int(k)] = v[:3]
+
+    return lut
+
+
+def compile_source(source):
+    """Compile (and cache) lookup tables for a source's remap recipe and colormap.
+
+    Cached tables are recompiled when a source's colormaps change (e.g. when
+    a catalog is reloaded).
+    """
+    remap_colormap = (source.recipes or {}).get("colormap")
+    palette_colormap = (source.meta or {}).get("colormap")
+
+    entry = LUTS.get(source.url)
+
+    if entry is not None:
+        compiled_remap, compiled_palette, luts = entry
+
+        # sources from the same catalog share decoded colormaps, so this is
+        # usually an identity check
+        if (compiled_remap is remap_colormap or compiled_remap == remap_colormap) and (
+            compiled_palette is palette_colormap or compiled_palette == palette_colormap
+        ):
+            return luts
+
+    remap = None
+    palette = None
+
+    try:
+        if remap_colormap is not None:
+            remap = compile_remap(remap_colormap)
+
+        if palette_colormap is not None:
+            palette = compile_palette(palette_colormap)
+    except (IndexError, OverflowError, TypeError, ValueError) as e:
+        # fall back to marblecutter's recipes for values that don't fit in a byte
+        LOG.warning("Unable to compile recipes for %s: %s", source.url, e)
+
+    LUTS[source.url] = (remap_colormap, palette_colormap, (remap, palette))
+
+    return remap, palette
+
+
+def apply(recipes, pixels, expand, source=None):
+    """Apply compiled lookup tables before deferring to marblecutter's recipes."""
+    data = pixels.data
+
+    if source is None or data.dtype != np.uint8 or data.shape[0] != 1:
+        return _apply(recipes, pixels, expand, source)
+
+    remap, palette = compile_source(source)
+
+    if expand == "meta" and palette is not None:
+        # expand raw values using the source's own colormap: (1, h, w) -> (3, h, w)
+        rgb = np.moveaxis(np.take(palette, data.data[0], axis=0), -1, 0)
+        mask = np.broadcast_to(np.ma.getmaskarray(data), rgb.shape)
+        pixels = pixels._replace(data=np.ma.masked_array(rgb, mask=mask))
+        recipes = {k: v for k, v in recipes.items() if k != "colormap"}
+        expand = False
+    elif remap is not None and "colormap" in recipes:
+        data = np.ma.masked_array(np.take(remap, data.data), mask=data.mask)
+        pixels = pixels._replace(data=data)
+        recipes = {k: v for k, v in recipes.items() if k != "colormap"}
+
+    return _apply(recipes, pixels, expand, source)
+
+
+def install():
+    """Route marblecutter's per-source recipe application through compiled lookup tables."""
+    recipes.apply = apply
@@ -0,0 +1,297 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import hashlib
+import itertools
+import json
+import logging
+import math
+from concurrent import futures
+
+import mercantile
+import numpy as np
+from cachetools.func import lru_cache
+from rasterio import features, transform, warp
+
+from .colormap import (
+    barren,
+    cultivated,
+    desert,
+    developed,
+    forest,
+    glacier,
+    herbaceous,
+    nothing,
+    shrubland,
+    water,
+    wetlands,
+)
+from .storage import read
+
+LOG = logging.getLogger(__name__)
+
+CLASSES = {
+    nothing: "nothing",
+    water: "water",
+    developed: "developed",
+    barren: "barren",
+    forest: "forest",
+    shrubland: "shrubland",
+    herbaceous: "herbaceous",
+    cultivated: "cultivated",
+    wetlands: "wetlands",
+    glacier: "glacier",
+    desert: "desert",
+}
+EARTH_RADIUS = 6378137
+MAX_LATITUDE = 85.0511287798066
+
+
+def row_areas(bounds, height, width):
+    """Calculate true (spherical) areas (in m²) of pixels in each row of a Web Mercator grid."""
+    left, bottom, right, top = bounds
+    dx = (right - left) / width
+    dy = (top - bottom) / height
+
+    ys = top - dy * (np.arange(height) + 0.5)
+    lats = 2 * np.arctan(np.exp(ys / EARTH_RADIUS)) - np.pi / 2
+
+    # Mercator scales distances by 1 / cos(lat) in both directions
+    return dx * dy * np.cos(lats) ** 2
+
+
+def class_areas(data, bounds, mask=None):
+    """Sum areas (in m²) of Web Mercator pixels by class."""
+    height, width = data.shape
+    weights = np.broadcast_to(row_areas(bounds, height, width)[:, np.newaxis], data.shape)
+
+    valid = ~np.ma.getmaskarray(data)
+    if mask is not None:
+        valid &= mask
+
+    areas = np.bincount(
+        np.ma.getdata(data)[valid].astype(np.intp), weights=weights[valid], minlength=256
+    )
+
+    return {int(c): float(areas[c]) for c in np.flatnonzero(areas)}
+
+
+class Summaries(object):
+    """Per-tile class-area summaries written alongside archives by landcover.tools.render."""
+
+    def __init__(self, url):
+        self.meta = json.loads(read(url).decode("utf-8"))
+        self.template = self.meta["summaries"]
+        self.materialized_zooms = sorted(self.meta["materializedZooms"])
+        self.metatile = self.meta.get("metatile", 1)
+        self.minzoom = self.meta["minzoom"]
+        self.maxzoom = self.meta["maxzoom"]
+
+    def get(self, tile):
+        """Get a tile's summary (or None if it wasn't rendered)."""
+        if not (self.minzoom <= tile.z <= self.maxzoom):
+            return None
+
+        zoom = max(z for z in self.materialized_zooms if z <= tile.z)
+        root = mercantile.parent(tile, zoom=zoom) if zoom < tile.z else tile
+        metatile = min(self.metatile, 2 ** zoom)
+        x = root.x - root.x % metatile
+        y = root.y - root.y % metatile
+
+        summaries = self._load(zoom, x, y)
+
+        if summaries is None:
+            return None
+
+        summary = summaries.get("{}/{}/{}".format(tile.z, tile.x, tile.y))
+
+        if summary is None:
+            return None
+
+        return {int(k): v for k, v in summary.items()}
+
+    @lru_cache(maxsize=1024)
+    def _load(self, z, x, y):
+        key = "{}/{}/{}".format(z, x, y)
+        h = hashlib.md5(key.encode("utf-8")).hexdigest()[:5]
+
+        try:
+            return json.loads(
+                read(self.template.format(z=z, x=x, y=y, h=h)).decode("utf-8")
+            )
+        except Exception as e:
+            LOG.warning("Unable to load summaries for %s: %s", key, e)
+            return None
+
+
+def to_mercator(geometry):
+    """Reproject a WGS84 GeoJSON geometry into Web Mercator, clamping latitudes."""
+
+    def clamp(coordinates):
+        if isinstance(coordinates[0], (float, int)):
+            return [
+                coordinates[0],
+                max(-MAX_LATITUDE, min(MAX_LATITUDE, coordinates[1])),
+            ]
+
+        return [clamp(c) for c in coordinates]
+
+    return warp.transform_geom(
+        "EPSG:4326",
+        "EPSG:3857",
+        {"type": geometry["type"], "coordinates": clamp(geometry["coordinates"])},
+    )
+
+
+def validate(geometry):
+    """Check that a GeoJSON geometry is a well-formed (Multi)Polygon, raising ValueError if not."""
+    if not isinstance(geometry, dict) or geometry.get("type") not in (
+        "Polygon",
+        "MultiPolygon",
+    ):
+        raise ValueError("A Polygon or MultiPolygon is required")
+
+    polygons = geometry.get("coordinates")
+    if geometry["type"] == "Polygon":
+        polygons = [polygons]
+
+    if not isinstance(polygons, list) or not polygons:
+        raise ValueError("coordinates must be a non-empty list")
+
+    for rings in polygons:
+        if not isinstance(rings, list) or not rings:
+            raise ValueError("Polygons must contain at least one ring")
+
+        for ring in rings:
+            if not isinstance(ring, list) or len(ring) < 4:
+                raise ValueError("Rings must contain at least 4 positions")
+
+            for position in ring:
+                if (
+                    not isinstance(position, list)
+                    or len(position) < 2
+                    or not all(
+                        isinstance(c, (int, float)) and math.isfinite(c)
+                        for c in position[:2]
+                    )
+                ):
+                    raise ValueError("Positions must be [<lon>, <lat>]")
+
+
+def boundary(geometry):
+    polygons = geometry["coordinates"]
+    if geometry["type"] == "Polygon":
+        polygons = [polygons]
+
+    return {
+        "type": "MultiLineString",
+        "coordinates": [ring for polygon in polygons for ring in polygon],
+    }
+
+
+def choose_zoom(bounds, min_zoom, max_zoom, max_tiles):
+    """Choose the highest zoom at which bounds are covered by at most max_tiles tiles."""
+    west, south, east, north = bounds
+
+    for z in range(max_zoom, min_zoom - 1, -1):
+        ul = mercantile.tile(west, north, z)
+        lr = mercantile.tile(east, south, z)
+
+        if (lr.x - ul.x + 1) * (lr.y - ul.y + 1) <= max_tiles:
+            return z
+
+    return min_zoom
+
+
+def classify_tiles(geometry, bounds, zoom):
+    """Split tiles covering a (Web Mercator) geometry into interior and edge tiles."""
+    west, south, east, north = bounds
+    ul = mercantile.tile(west, north, zoom)
+    lr = mercantile.tile(east, south, zoom)
+    width = lr.x - ul.x + 1
+    height = lr.y - ul.y + 1
+
+    left, _, _, top = mercantile.xy_bounds(ul)
+    _, bottom, right, _ = mercantile.xy_bounds(lr)
+    t = transform.from_bounds(left, bottom, right, top, width, height)
+
+    touched = features.rasterize(
+        [geometry], out_shape=(height, width), transform=t, all_touched=True
+    ).astype(bool)
+    edges = features.rasterize(
+        [boundary(geometry)], out_shape=(height, width), transform=t, all_touched=True
+    ).astype(bool)
+
+    def tiles(cells):
+        return [mercantile.Tile(ul.x + col, ul.y + row, zoom) for row, col in zip(*cells)]
+
+    return tiles(np.nonzero(touched & ~edges)), tiles(np.nonzero(touched & edges))
+
+
+def area_stats(
+    geometry,
+    render,
+    summaries=None,
+    min_zoom=0,
+    max_zoom=14,
+    max_tiles=256,
+    max_renders=None,
+    concurrency=1,
+):
+    """Calculate areas (in km²) of each class within a WGS84 (Multi)Polygon.
+
+    Interior tiles are read from summaries where available; edge tiles (and
+    interior tiles without summaries) are rendered (up to `concurrency` at a
+    time) using `render(tile, geometry)`, which should return areas (in m²) by
+    class within the (Web Mercator) geometry. When more than `max_renders`
+    tiles would need to be rendered, lower zooms are used.
+    """
+    xs, ys = zip(*(c for r in boundary(geometry)["coordinates"] for c in r))
+    # stay within the world's tiles
+    bounds = (
+        max(-180, min(xs)),
+        max(-MAX_LATITUDE + 1e-9, min(ys)),
+        min(180 - 1e-9, max(xs)),
+        min(MAX_LATITUDE, max(ys)),
+    )
+
+    if summaries is not None:
+        max_zoom = min(max_zoom, summaries.maxzoom)
+        min_zoom = max(min_zoom, summaries.minzoom)
+
+    geometry = to_mercator(geometry)
+
+    for zoom in range(choose_zoom(bounds, min_zoom, max_zoom, max_tiles), min_zoom - 1, -1):
+        interior, edge = classify_tiles(geometry, bounds, zoom)
+        summarized = []
+        jobs = [(tile, geometry) for tile in edge]
+
+        for tile in interior:
+            summary = summaries.get(tile) if summaries is not None else None
+
+            if summary is None:
+                jobs.append((tile, None))
+            else:
+                summarized.append(summary)
+
+        if max_renders is None or len(jobs) <= max_renders or zoom == min_zoom:
+            break
+
+    totals = np.zeros(256)
+
+    with futures.ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        rendered = executor.map(lambda job: render(*job), jobs)
+
+        for summary in itertools.chain(summarized, rendered):
+            for c, area in summary.items():
+                totals[c] += area
+
+    return {
+        "zoom": zoom,
+        "tiles": {"summarized": len(summarized), "rendered": len(jobs)},
+        "area": float(totals.sum()) / 1e6,
+        "classes": {
+            CLASSES.get(int(c), str(c)): float(totals[c]) / 1e6
+            for c in np.flatnonzero(totals)
+        },
+    }
@@ -0,0 +1,56 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import logging
+from os import makedirs, path
+from urllib.parse import urlparse
+
+import boto3
+import botocore
+
+LOG = logging.getLogger(__name__)
+S3 = boto3.client("s3")
+
+
+def read(target):
+    url = urlparse(target)
+
+    if url.scheme in ("", "file"):
+        with open(path.abspath(url.netloc + url.path), "rb") as f:
+            return f.read()
+    elif url.scheme == "s3":
+        return S3.get_object(Bucket=url.netloc, Key=url.path[1:])["Body"].read()
+
+    raise Exception("Unsupported URL: {}".format(target))
+
+
+def write(body, target, content_type="application/zip", strict=False):
+    """Write to a local path or S3; S3 errors are logged (or raised, if strict)."""
+    url = urlparse(target)
+
+    if url.scheme in ("", "file"):
+        target = path.abspath(url.netloc + url.path)
+
+        if not path.isdir(path.dirname(target)):
+            makedirs(path.dirname(target))
+
+        if isinstance(body, str):
+            mode = "w"
+        else:
+            mode = "wb"
+
+        with open(target, mode) as out:
+            out.write(body)
+    elif url.scheme == "s3":
+        bucket = url.netloc
+        key = url.path[1:]
+
+        try:
+            S3.put_object(
+                Body=body, Bucket=bucket, Key=key, ContentType=content_type
+            )
+        except botocore.exceptions.ClientError as e:
+            if strict:
+                raise
+
+            LOG.exception(e)
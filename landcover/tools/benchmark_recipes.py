@@ -0,0 +1,100 @@
+# coding=utf-8
+from __future__ import print_function
+
+import argparse
+import json
+import timeit
+
+import mercantile
+import numpy as np
+from marblecutter.tiling import WEB_MERCATOR_CRS
+from marblecutter.utils import Bounds, PixelCollection, Source
+
+from .. import recipes
+
+TILE = mercantile.Tile(0, 0, 0)
+
+# NLCD -> unified classes, as stored in the catalog
+NLCD_RECIPES = json.dumps(
+    {
+        "colormap": {
+            "11": 10,
+            "12": 100,
+            "21": 30,
+            "22": 20,
+            "23": 20,
+            "24": 20,
+            "31": 110,
+            "41": 40,
+            "42": 40,
+            "43": 40,
+            "51": 50,
+            "52": 50,
+            "71": 70,
+            "72": 70,
+            "73": 70,
+            "74": 70,
+            "81": 70,
+            "82": 80,
+            "90": 90,
+            "95": 90,
+        }
+    }
+)
+
+
+def nlcd_tile(size):
+    values = np.array([int(k) for k in json.loads(NLCD_RECIPES)["colormap"]] + [0])
+    data = np.random.choice(values, size=(1, size, size)).astype(np.uint8)
+
+    return PixelCollection(
+        np.ma.masked_equal(data, 0), Bounds(mercantile.xy_bounds(TILE), WEB_MERCATOR_CRS)
+    )
+
+
+def nlcd_source():
+    return Source(
+        "s3://land-cover-sources/NLCD/benchmark.tif",
+        "NLCD",
+        30,
+        {},
+        {},
+        json.loads(NLCD_RECIPES),
+        None,
+        None,
+        0,
+        None,
+    )
+
+
+# E.g. python3 -m landcover.tools.benchmark_recipes -s 512 -n 100
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", "-s", type=int, default=512, help="Tile size")
+    parser.add_argument("--number", "-n", type=int, default=100, help="Iterations")
+
+    args = parser.parse_args()
+
+    pixels = nlcd_tile(args.size)
+    source = nlcd_source()
+
+    # marblecutter's recipes (the per-tile path) vs. compiled lookup tables
+    expected = recipes._apply(source.recipes, pixels, False, source)
+    actual = recipes.apply(source.recipes, pixels, False, source)
+
+    assert (np.ma.getdata(expected.data) == np.ma.getdata(actual.data)).all()
+    assert (np.ma.getmaskarray(expected.data) == np.ma.getmaskarray(actual.data)).all()
+
+    for name, fn in (("marblecutter", recipes._apply), ("compiled", recipes.apply)):
+        elapsed = min(
+            timeit.repeat(
+                lambda: fn(source.recipes, pixels, False, source),
+                number=args.number,
+                repeat=3,
+            )
+        )
+        print(
+            "{}: {:.03f}ms / {}x{} tile".format(
+                name, elapsed / args.number * 1000, args.size, args.size
+            )
+        )
@@ -0,0 +1,75 @@
+# coding=utf-8
+from __future__ import print_function
+
+import argparse
+import logging
+import multiprocessing
+
+from marblecutter.catalogs.postgis import PostGISCatalog
+
+from ..export import export
+from ..recipes import install as install_recipes
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+logging.getLogger("botocore.credentials").setLevel(logging.WARNING)
+logging.getLogger("marblecutter.mosaic").setLevel(logging.WARNING)
+logging.getLogger("rasterio._base").setLevel(logging.WARNING)
+
+CATALOG = PostGISCatalog(table="land_cover")
+
+install_recipes()
+
+
+# E.g. python3 -m landcover.tools.export -b -123.2 37.6 -122.3 38.0 -z 14 sf.tif
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--bbox",
+        "-b",
+        type=float,
+        nargs=4,
+        required=True,
+        metavar=("WEST", "SOUTH", "EAST", "NORTH"),
+        help="Bounding box (in WGS84)",
+    )
+    resolution = parser.add_mutually_exclusive_group(required=True)
+    resolution.add_argument(
+        "--zoom", "-z", type=int, help="Zoom level to derive the resolution from"
+    )
+    resolution.add_argument(
+        "--resolution", "-r", type=float, help="Resolution (in target CRS units)"
+    )
+    parser.add_argument("--crs", default="EPSG:3857", help="Target CRS")
+    parser.add_argument(
+        "--window-size",
+        "-w",
+        type=int,
+        default=2048,
+        help="Size of windows to render at once (in pixels)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        "-c",
+        type=int,
+        default=multiprocessing.cpu_count(),
+        help="Number of windows to render concurrently",
+    )
+    parser.add_argument("--verbose", "-v", action="store_true")
+    parser.add_argument("target", help="Target path/URI for the COG")
+
+    args = parser.parse_args()
+
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+
+    export(
+        CATALOG,
+        args.bbox,
+        args.target,
+        crs=args.crs,
+        resolution=args.resolution,
+        zoom=args.zoom,
+        window_size=args.window_size,
+        concurrency=args.concurrency,
+    )
@@ -0,0 +1,734 @@
+# coding=utf-8
+from __future__ import print_function
+
+import argparse
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+import mercantile
+import numpy as np
+
+from ..catalogs import SpatialiteCatalog, localize
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+ROUTES = {
+    "/z/x/y": "/{z}/{x}/{y}",
+    ".json": "/{z}/{x}/{y}.json",
+    ".tif": "/{z}/{x}/{y}.tif",
+    "/raw/": "/raw/{z}/{x}/{y}",
+}
+# tile paths, as logged by gunicorn: "GET /12/654/1583 HTTP/1.1"
+REQUEST = re.compile(r'"GET (/(?:raw/)?\d+/\d+/\d+(?:@[\d.]+x)?(?:\.\w+)?)(?:\?\S*)? HTTP/[\d.]+"')
+# meters per degree (at the equator)
+DEGREE = 2 * math.pi * 6378137 / 360
+
+
+def route(path):
+    if path.startswith("/raw/"):
+        return "/raw/"
+
+    if path.endswith(".json"):
+        return ".json"
+
+    if path.endswith(".tif"):
+        return ".tif"
+
+    return "/z/x/y"
+
+
+def parse_weights(value, key=str):
+    weights = {}
+
+    for pair in value.split(","):
+        k, v = pair.rsplit(":", 1)
+        weights[key(k)] = float(v)
+
+    return weights
+
+
+def read_log(path):
+    """Extract tile requests from gunicorn access logs."""
+    with open(path) as f:
+        for line in f:
+            match = REQUEST.search(line)
+
+            if match:
+                yield match.group(1)
+
+
+def synthesize(extents, zooms, routes, focus, count, seed):
+    """Generate tile requests with zooms and routes drawn from weighted distributions.
+
+    A `focus` fraction of tiles fall within source footprints; the rest are
+    uniformly distributed (and mostly served by global sources).
+    """
+    rng = random.Random(seed)
+    bboxes = list(extents.values())
+    zs, z_weights = zip(*sorted(zooms.items()))
+    names, route_weights = zip(*sorted(routes.items()))
+
+    for _ in range(count):
+        z = rng.choices(zs, z_weights)[0]
+
+        if bboxes and rng.random() < focus:
+            west, south, east, north = rng.choice(bboxes)
+            tile = mercantile.tile(
+                min(rng.uniform(west, east), 180 - 1e-9),
+                max(-85, min(85, rng.uniform(south, north))),
+                z,
+            )
+        else:
+            tile = mercantile.Tile(rng.randrange(2 ** z), rng.randrange(2 ** z), z)
+
+        yield ROUTES[rng.choices(names, route_weights)[0]].format(
+            z=tile.z, x=tile.x, y=tile.y
+        )
+
+
+def make_fixtures(catalog, root, size, seed):
+    """Write stand-in COGs for catalog sources that aren't already mirrored under root.
+
+    Fixtures cover each footprint's bounding box (in WGS84) at the source's
+    resolution, capped at `size` pixels per side, and are filled with patches
+    of the source's raw values.
+    """
+    import rasterio
+    import rasterio.shutil
+    from rasterio.enums import Resampling
+    from rasterio.io import MemoryFile
+    from rasterio.transform import from_bounds
+
+    rng = np.random.RandomState(seed)
+    extents = catalog.extents()
+
+    for source in catalog.registry().values():
+        path = localize(source.url, root)
+
+        if os.path.exists(path):
+            continue
+
+        west, south, east, north = extents[source.url]
+        resolution = source.resolution / DEGREE
+        width = int(max(1, min(size, math.ceil((east - west) / resolution))))
+        height = int(max(1, min(size, math.ceil((north - south) / resolution))))
+
+        values = [int(v) for v in (source.recipes or {}).get("colormap", {})]
+        values = np.array(values or range(1, 10), dtype=np.uint8)
+        nodata = (source.meta or {}).get("nodata")
+
+        patches = rng.choice(values, size=(height // 16 + 1, width // 16 + 1))
+        data = np.kron(patches, np.ones((16, 16), dtype=np.uint8))[:height, :width]
+
+        profile = {
+            "driver": "GTiff",
+            "width": width,
+            "height": height,
+            "count": 1,
+            "dtype": "uint8",
+            "crs": "EPSG:4326",
+            "transform": from_bounds(west, south, east, north, width, height),
+            "nodata": nodata,
+            "tiled": True,
+            "blockxsize": 512,
+            "blockysize": 512,
+        }
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        logger.info("Writing %dx%d fixture for %s to %s", width, height, source.url, path)
+
+        with MemoryFile() as memfile:
+            with memfile.open(**profile) as dst:
+                dst.write(data, 1)
+
+                factors = []
+                factor = 2
+                while max(width, height) / factor >= 256:
+                    factors.append(factor)
+                    factor *= 2
+
+                dst.build_overviews(factors, Resampling.mode)
+
+            with memfile.open() as src:
+                rasterio.shutil.copy(
+                    src,
+                    path,
+                    driver="GTiff",
+                    copy_src_overviews=True,
+                    tiled=True,
+                    blockxsize=512,
+                    blockysize=512,
+                    compress="deflate",
+                )
+
+
+def fetch(url, timeout):
+    start = time.perf_counter()
+
+    try:
+        with urlopen(url, timeout=timeout) as rsp:
+            rsp.read()
+            status = rsp.status
+    except HTTPError as e:
+        status = e.code
+    except Exception as e:
+        logger.debug("%s: %s", url, e)
+        status = 0
+
+    return status, time.perf_counter() - start
+
+
+def replay(base_url, paths, concurrency, timeout):
+    """Issue requests from `concurrency` closed-loop clients; returns (route, status, latency) and elapsed time."""
+    paths = iter(paths)
+    lock = threading.Lock()
+    results = []
+
+    def client():
+        while True:
+            with lock:
+                path = next(paths, None)
+
+            if path is None:
+                return
+
+            status, latency = fetch(base_url + path, timeout)
+            results.append((route(path), status, latency))
+
+    start = time.perf_counter()
+    clients = [threading.Thread(target=client) for _ in range(concurrency)]
+
+    for t in clients:
+        t.start()
+
+    for t in clients:
+        t.join()
+
+    return results, time.perf_counter() - start
+
+
+def summarize(results, elapsed):
+    by_route = defaultdict(list)
+
+    for name, status, latency in results:
+        by_route[name].append((status, latency))
+        by_route["all"].append((status, latency))
+
+    summary = {}
+    for name, values in by_route.items():
+        statuses = np.array([s for s, _ in values])
+        latencies = np.array([t for _, t in values]) * 1000
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+
+        summary[name] = {
+            "requests": len(values),
+            "rps": len(values) / elapsed,
+            "errors": int(np.count_nonzero((statuses == 0) | (statuses >= 500))),
+            "shed": int(np.count_nonzero(statuses == 503)),
+            "p50": float(p50),
+            "p95": float(p95),
+            "p99": float(p99),
+        }
+
+    return summary
+
+
+def get_metrics(base_url, workers, timeout, attempts=10):
+    """Poll /metrics until every worker (probably) has answered; keyed by pid."""
+    metrics = {}
+
+    for _ in range(max(1, workers) * attempts):
+        try:
+            with urlopen(base_url + "/metrics", timeout=timeout) as rsp:
+                m = json.loads(rsp.read().decode("utf-8"))
+                metrics[m["pid"]] = m
+        except Exception as e:
+            logger.debug("Unable to fetch metrics: %s", e)
+
+        if len(metrics) >= workers:
+            break
+
+    return metrics
+
+
+def hit_rates(before, after):
+    """Calculate cache hit rates across workers between two sets of metrics."""
+    totals = defaultdict(lambda: [0, 0])
+
+    for pid, m in after.items():
+        for cache in ("catalog", "single_flight"):
+            if cache not in m:
+                continue
+
+            prev = before.get(pid, {}).get(cache, {"hits": 0, "misses": 0})
+            totals[cache][0] += m[cache]["hits"] - prev["hits"]
+            totals[cache][1] += m[cache]["misses"] - prev["misses"]
+
+    return {
+        cache: hits / (hits + misses) if hits + misses else None
+        for cache, (hits, misses) in totals.items()
+    }
+
+
+def io_rates(before, after, requests):
+    """Calculate reads per request and GDAL block cache usage across workers.
+
+    Storage reads (page cache hits excluded) reflect VSI caching; read
+    syscalls and bytes also include client socket reads, so they grow with
+    traffic regardless of caching. A GDAL block cache that's full (used ≈
+    max) is probably too small.
+    """
+    totals = defaultdict(int)
+    cache_used = []
+    cache_max = None
+
+    for pid, m in after.items():
+        io = m.get("io")
+        prev = (before.get(pid) or {}).get("io") or {}
+
+        if io is not None:
+            for k in ("reads", "read_bytes", "storage_bytes"):
+                totals[k] += io[k] - prev.get(k, 0)
+
+        if m.get("gdal_cache") is not None:
+            cache_used.append(m["gdal_cache"]["used"])
+            cache_max = m["gdal_cache"]["max"]
+
+    rates = {
+        "{}_per_request".format(k): v / requests if requests else None
+        for k, v in totals.items()
+    }
+    rates.update(
+        gdal_cache_used=max(cache_used) if cache_used else None,
+        gdal_cache_max=cache_max,
+    )
+
+    return rates
+
+
+def children(pid):
+    pids = []
+
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+
+        try:
+            with open("/proc/{}/stat".format(entry)) as f:
+                # pid (comm) state ppid ...
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (IOError, IndexError, ValueError):
+            continue
+
+        if ppid == pid:
+            pids.append(int(entry))
+
+    return pids
+
+
+def peak_rss(pid):
+    """Read a process's peak resident set size (in kB)."""
+    try:
+        with open("/proc/{}/status".format(pid)) as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+
+        return s.getsockname()[1]
+
+
+def start_server(env, timeout):
+    port = free_port()
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            "-t",
+            "300",
+            "-k",
+            "gevent",
+            "-b",
+            "127.0.0.1:{}".format(port),
+            "landcover.web:app",
+        ],
+        env=env,
+    )
+    base_url = "http://127.0.0.1:{}".format(port)
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise Exception("gunicorn exited with {}".format(server.returncode))
+
+        try:
+            with urlopen(base_url + "/metrics", timeout=1):
+                return server, base_url
+        except Exception:
+            time.sleep(0.5)
+
+    server.terminate()
+    raise Exception("gunicorn didn't start within {}s".format(timeout))
+
+
+def run(base_url, paths, concurrencies, workers, args, server=None):
+    """Step through client concurrencies until throughput stops improving."""
+    levels = []
+
+    if args.warmup:
+        replay(base_url, paths[: args.warmup], concurrencies[0], args.timeout)
+
+    for concurrency in concurrencies:
+        before = get_metrics(base_url, workers, args.timeout)
+        results, elapsed = replay(base_url, paths, concurrency, args.timeout)
+        after = get_metrics(base_url, workers, args.timeout)
+
+        level = {
+            "concurrency": concurrency,
+            "routes": summarize(results, elapsed),
+            "hit_rates": hit_rates(before, after),
+            "io": io_rates(before, after, len(results)),
+        }
+        levels.append(level)
+
+        overall = level["routes"]["all"]
+        logger.info(
+            "c=%d: %.1f req/s, p50=%.0fms p95=%.0fms p99=%.0fms, %d errors (%d shed)",
+            concurrency,
+            overall["rps"],
+            overall["p50"],
+            overall["p95"],
+            overall["p99"],
+            overall["errors"],
+            overall["shed"],
+        )
+
+        if saturated(levels, args.tolerance, args.max_error_rate):
+            break
+
+    if server is not None:
+        rss = {pid: peak_rss(pid) for pid in children(server.pid)}
+    else:
+        rss = {pid: m["maxrss"] for pid, m in after.items()}
+
+    # the last level that improved throughput (or the last level tried)
+    saturation = levels[-1]
+    if len(levels) > 1 and saturated(levels, args.tolerance, args.max_error_rate):
+        saturation = levels[-2]
+
+    return {
+        "levels": levels,
+        "saturation": {
+            "concurrency": saturation["concurrency"],
+            "rps": saturation["routes"]["all"]["rps"],
+            "p99": saturation["routes"]["all"]["p99"],
+        },
+        "peak_rss": rss,
+    }
+
+
+def saturated(levels, tolerance, max_error_rate):
+    overall = levels[-1]["routes"]["all"]
+
+    if overall["errors"] > max_error_rate * overall["requests"]:
+        return True
+
+    if len(levels) < 2:
+        return False
+
+    return overall["rps"] < levels[-2]["routes"]["all"]["rps"] * (1 + tolerance)
+
+
+def report(config, result):
+    print()
+    print(
+        "WEB_CONCURRENCY={workers} GDAL_CACHEMAX={gdal_cachemax} VSI_CACHE_SIZE={vsi_cache_size}".format(
+            **config
+        )
+    )
+
+    for level in result["levels"]:
+        print("  concurrency={}".format(level["concurrency"]))
+        print(
+            "    {:<8} {:>8} {:>9} {:>8} {:>8} {:>8} {:>7}".format(
+                "route", "requests", "req/s", "p50 ms", "p95 ms", "p99 ms", "errors"
+            )
+        )
+
+        for name in list(ROUTES) + ["all"]:
+            if name not in level["routes"]:
+                continue
+
+            r = level["routes"][name]
+            print(
+                "    {:<8} {:>8} {:>9.1f} {:>8.0f} {:>8.0f} {:>8.0f} {:>7}".format(
+                    name, r["requests"], r["rps"], r["p50"], r["p95"], r["p99"], r["errors"]
+                )
+            )
+
+        print(
+            "    cache hit rates: {}".format(
+                ", ".join(
+                    "{}={}".format(k, "-" if v is None else "{:.1%}".format(v))
+                    for k, v in sorted(level["hit_rates"].items())
+                )
+            )
+        )
+
+        io = level["io"]
+        if io.get("storage_bytes_per_request") is not None:
+            print(
+                "    storage reads/request: {:.1f} kB; read syscalls/request (incl. sockets): {:.1f} ({:.1f} kB)".format(
+                    io["storage_bytes_per_request"] / 1024,
+                    io["reads_per_request"],
+                    io["read_bytes_per_request"] / 1024,
+                )
+            )
+
+        if io["gdal_cache_used"] is not None:
+            print(
+                "    GDAL block cache: {:.0f} / {:.0f} MB (max across workers)".format(
+                    io["gdal_cache_used"] / 2 ** 20, io["gdal_cache_max"] / 2 ** 20
+                )
+            )
+
+    print(
+        "  peak RSS per worker (MB): {}".format(
+            ", ".join(
+                "{}={:.0f}".format(pid, rss / 1024)
+                for pid, rss in sorted(result["peak_rss"].items())
+                if rss is not None
+            )
+        )
+    )
+    print(
+        "  saturation: concurrency={concurrency}, {rps:.1f} req/s, p99={p99:.0f}ms".format(
+            **result["saturation"]
+        )
+    )
+
+
+def csv(value, type=str):
+    return [type(v) for v in value.split(",")]
+
+
+# E.g. python3 -m landcover.tools.loadtest --catalog catalog/land_cover.sql.gz --source-root fixtures --make-fixtures -w 1,2,4
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--log",
+        action="append",
+        help="gunicorn access log to replay (may be repeated; defaults to synthetic requests)",
+    )
+    parser.add_argument(
+        "--requests", "-n", type=int, default=1000, help="Requests per concurrency level"
+    )
+    parser.add_argument(
+        "--zooms",
+        default="2:1,4:2,6:4,8:6,10:6,11:5,12:4,13:3,14:2",
+        help="Zoom weights for synthetic requests",
+    )
+    parser.add_argument(
+        "--routes",
+        default="/z/x/y:8,.json:1,.tif:0.5,/raw/:0.5",
+        help="Route weights for synthetic requests",
+    )
+    parser.add_argument(
+        "--focus",
+        type=float,
+        default=0.5,
+        help="Fraction of synthetic requests within source footprints",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument(
+        "--catalog",
+        default="catalog/land_cover.sql.gz",
+        help="Catalog dump or snapshot to serve (CATALOG_PATH)",
+    )
+    parser.add_argument(
+        "--source-root",
+        help="Local mirror of source URLs (SOURCE_ROOT), e.g. s3://bucket/key -> {root}/bucket/key",
+    )
+    parser.add_argument(
+        "--make-fixtures",
+        action="store_true",
+        help="Write stand-in COGs for sources missing from --source-root",
+    )
+    parser.add_argument(
+        "--fixture-size",
+        type=int,
+        default=4096,
+        help="Maximum fixture width/height (in pixels)",
+    )
+    parser.add_argument(
+        "--url", help="Test a running server instead of starting (and sweeping) gunicorn"
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=lambda v: csv(v, int),
+        default=[1],
+        help="WEB_CONCURRENCY values to sweep (or the number of workers behind --url)",
+    )
+    parser.add_argument(
+        "--gdal-cachemax", type=csv, default=["64"], help="GDAL_CACHEMAX values to sweep"
+    )
+    parser.add_argument(
+        "--vsi-cache-size",
+        type=csv,
+        default=["0"],
+        help="VSI_CACHE_SIZE values (in bytes) to sweep; 0 sets VSI_CACHE=FALSE",
+    )
+    parser.add_argument(
+        "--concurrency",
+        "-c",
+        type=lambda v: csv(v, int),
+        default=[1, 2, 4, 8, 16, 32, 64],
+        help="Client concurrency levels",
+    )
+    parser.add_argument(
+        "--warmup", type=int, default=100, help="Unmeasured requests before each sweep"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.05,
+        help="Minimum throughput gain before a level is considered saturated",
+    )
+    parser.add_argument(
+        "--max-error-rate",
+        type=float,
+        default=0.01,
+        help="Error rate at which a level is considered saturated",
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=60, help="Request timeout (in seconds)"
+    )
+    parser.add_argument(
+        "--startup-timeout",
+        type=float,
+        default=120,
+        help="Time to wait for gunicorn to load the catalog (in seconds)",
+    )
+    parser.add_argument("--output", "-o", help="Write results (as JSON) to this file")
+
+    args = parser.parse_args()
+
+    catalog = SpatialiteCatalog()
+
+    if args.catalog.endswith((".sqlite", ".sqlite3", ".db")):
+        catalog.load_snapshot(args.catalog)
+    else:
+        catalog.load_dump(args.catalog)
+
+    if args.make_fixtures:
+        if args.source_root is None:
+            raise Exception("--make-fixtures requires --source-root")
+
+        make_fixtures(catalog, args.source_root, args.fixture_size, args.seed)
+
+    if args.log:
+        paths = [p for log in args.log for p in read_log(log)]
+
+        if not paths:
+            raise Exception("No tile requests found in {}".format(", ".join(args.log)))
+
+        # replay in order, repeating as necessary
+        paths = list(itertools.islice(itertools.cycle(paths), args.requests))
+    else:
+        paths = list(
+            synthesize(
+                catalog.extents(),
+                parse_weights(args.zooms, int),
+                parse_weights(args.routes),
+                args.focus,
+                args.requests,
+                args.seed,
+            )
+        )
+
+    results = []
+
+    if args.url:
+        base_url = args.url.rstrip("/")
+        workers = max(args.workers)
+        config = {"workers": "?", "gdal_cachemax": "?", "vsi_cache_size": "?"}
+        result = run(base_url, paths, args.concurrency, workers, args)
+        report(config, result)
+        results.append(dict(config=config, **result))
+    else:
+        for workers, gdal_cachemax, vsi_cache_size in itertools.product(
+            args.workers, args.gdal_cachemax, args.vsi_cache_size
+        ):
+            config = {
+                "workers": workers,
+                "gdal_cachemax": gdal_cachemax,
+                "vsi_cache_size": vsi_cache_size,
+            }
+
+            env = dict(
+                os.environ,
+                WEB_CONCURRENCY=str(workers),
+                GDAL_CACHEMAX=gdal_cachemax,
+                CATALOG_PATH=os.path.abspath(args.catalog),
+                ENABLE_METRICS="true",
+            )
+
+            if vsi_cache_size == "0":
+                # explicitly, since the Docker image enables it
+                env["VSI_CACHE"] = "FALSE"
+                env.pop("VSI_CACHE_SIZE", None)
+            else:
+                env.update(VSI_CACHE="TRUE", VSI_CACHE_SIZE=vsi_cache_size)
+
+            if args.source_root is not None:
+                env["SOURCE_ROOT"] = os.path.abspath(args.source_root)
+
+            server, base_url = start_server(env, args.startup_timeout)
+
+            try:
+                result = run(
+                    base_url, paths, args.concurrency, workers, args, server=server
+                )
+            finally:
+                server.terminate()
+                server.wait()
+
+            report(config, result)
+            results.append(dict(config=config, **result))
+
+        best = max(results, key=lambda r: r["saturation"]["rps"])
+        print()
+        print(
+            "Best: WEB_CONCURRENCY={workers} GDAL_CACHEMAX={gdal_cachemax} VSI_CACHE_SIZE={vsi_cache_size}".format(
+                **best["config"]
+            ),
+            "saturates at concurrency={concurrency} ({rps:.1f} req/s, p99={p99:.0f}ms)".format(
+                **best["saturation"]
+            ),
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -8,16 +8,19 @@ import json
 import logging
 import math
 import multiprocessing
+import os
+import socket
+import time
+import traceback
 from bisect import bisect_right
+from collections import deque
 from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
 from io import BytesIO
-from os import makedirs, path
+from os import path
 from time import gmtime
-from urllib.parse import urlparse
 from zipfile import ZIP_DEFLATED, ZipFile, ZipInfo
 
-import boto3
-import botocore
 import mercantile
 from marblecutter import get_resolution_in_meters, tiling
 from marblecutter.catalogs import WGS84_CRS
@@ -30,10 +33,16 @@ from marblecutter.transformations import Colormap, Transformation
 from marblecutter.utils import Bounds
 from mercantile import Tile
 from rasterio import Affine
+from shapely.geometry import mapping, shape
+from shapely.ops import clip_by_rect
 
 from ..catalogs import SpatialiteCatalog
 from ..colormap import COLORMAP
-from ..formats import GeoJSON
+from ..formats import GeoJSON, clip
+from ..recipes import install as install_recipes
+from ..stats import class_areas
+from ..storage import write
+from .work_queue import Heartbeat, WorkQueue
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -45,7 +54,13 @@ CATALOG = PostGISCatalog(table="land_cover")
 COLORMAP_TRANSFORMATION = Colormap(COLORMAP)
 GEOTIFF_FORMAT = GeoTIFF(colormap=COLORMAP)
 PNG_FORMAT = PNG(paletted=True)
-S3 = boto3.client("s3")
+# read-only source registry (populated when sources are cached locally); forked
+# sub-processes inherit it, so tasks only need to carry compact source ids
+SOURCES = None
+# parsed source masks, keyed by source id (populated lazily in each sub-process)
+MASKS = {}
+
+install_recipes()
 
 
 def build_catalog(tile, min_zoom, max_zoom):
@@ -59,11 +74,40 @@ def build_catalog(tile, min_zoom, max_zoom):
     return catalog
 
 
+def resolve_sources(ids, tile):
+    """Look up sources in the registry, clipping their masks to a tile's bounds.
+
+    The registry holds unclipped masks; clipping them here (as the catalog
+    does when querying) keeps detailed masks from being reprojected and
+    rasterized in full for every tile.
+    """
+    sources = []
+
+    for id in ids:
+        source = SOURCES[id]
+
+        if source.mask is not None:
+            if id not in MASKS:
+                MASKS[id] = shape(source.mask)
+
+            # masks are only rasterized, so a fast (possibly invalid) clip is fine
+            mask = clip_by_rect(MASKS[id], *mercantile.bounds(tile))
+            source = source._replace(mask=None if mask.is_empty else mapping(mask))
+
+        sources.append(source)
+
+    return sources
+
+
 # TODO fold this upstream, e.g. footprints.something
-def upstream_sources_for_tile(tile, catalog, min_zoom=None, max_zoom=None):
-    """Render a tile's source footprints."""
-    bounds = Bounds(mercantile.xy_bounds(tile), WEB_MERCATOR_CRS)
-    shape = (512, 512)
+def upstream_sources_for_tile(tile, catalog, min_zoom=None, max_zoom=None, size=1):
+    """Render the source footprints of a tile (or a size x size metatile)."""
+    left, _, _, top = mercantile.xy_bounds(tile)
+    _, bottom, right, _ = mercantile.xy_bounds(
+        Tile(tile.x + size - 1, tile.y + size - 1, tile.z)
+    )
+    bounds = Bounds((left, bottom, right, top), WEB_MERCATOR_CRS)
+    shape = (512 * size, 512 * size)
     resolution = get_resolution_in_meters(bounds, shape)
 
     return catalog.get_sources(
@@ -76,20 +120,89 @@ def upstream_sources_for_tile(tile, catalog, min_zoom=None, max_zoom=None):
 
 
 def generate_tiles(tile, max_zoom, metatile=1, materialize_zooms=None):
-    tiles = []
+    """Generate tiles from a (meta)tile down to max_zoom.
+
+    Tiles are generated depth-first in Z-order, so memory use is proportional to
+    the depth of the pyramid and consecutive tiles cover neighboring areas
+    (and read the same blocks from sources).
+    """
     metatile = min(metatile, 2 ** tile.z)
 
-    for dx in range(0, metatile):
-        for dy in range(0, metatile):
-            tiles.append(Tile(tile.x + dx, tile.y + dy, tile.z))
+    for i in range(metatile * metatile):
+        dx, dy = deinterleave(i)
+
+        yield from descend(
+            Tile(tile.x + dx, tile.y + dy, tile.z), max_zoom, materialize_zooms
+        )
+
+
+def descend(tile, max_zoom, materialize_zooms=None):
+    if materialize_zooms is None or tile.z in materialize_zooms:
+        yield tile
+
+    if tile.z < max_zoom:
+        for dy in (0, 1):
+            for dx in (0, 1):
+                yield from descend(
+                    Tile(tile.x * 2 + dx, tile.y * 2 + dy, tile.z + 1),
+                    max_zoom,
+                    materialize_zooms,
+                )
+
+
+def deinterleave(i):
+    """Convert a Z-order (Morton) index into x and y offsets."""
+    x = y = 0
+    bit = 0
 
-    for z in range(tile.z, max_zoom + 1):
-        if materialize_zooms is None or z in materialize_zooms:
-            a, tiles = itertools.tee(tiles, 2)
+    while i:
+        x |= (i & 1) << bit
+        y |= ((i >> 1) & 1) << bit
+        i >>= 2
+        bit += 1
 
-            yield from a
+    return x, y
 
-        tiles = itertools.chain.from_iterable(mercantile.children(t) for t in tiles)
+
+def generate_blocks(tile, max_zoom, metatile=1):
+    """Generate (block, size) pairs covering the tiles in a (meta)tile's pyramid.
+
+    Each block is the ancestor of a size x size group of tiles (size being the
+    metatile size, limited by the number of tiles at that zoom).
+    """
+    for t in generate_tiles(tile, max_zoom, metatile):
+        size = min(metatile, 2 ** t.z)
+
+        if t.x % size == 0 and t.y % size == 0:
+            k = size.bit_length() - 1
+
+            yield (Tile(t.x >> k, t.y >> k, t.z - k), size)
+
+
+def block_tiles(block, size):
+    k = size.bit_length() - 1
+
+    return generate_tiles(
+        Tile(block.x << k, block.y << k, block.z + k), block.z + k, size
+    )
+
+
+def bounded_map(executor, fn, iterable, window):
+    """Like Executor.map, but with at most `window` tasks in flight.
+
+    Inputs are consumed lazily and results are yielded in order, so memory
+    use is bounded by the window rather than the number of inputs.
+    """
+    pending = deque()
+
+    for item in iterable:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+
+        pending.append(executor.submit(fn, item))
+
+    while pending:
+        yield pending.popleft().result()
 
 
 def subpyramids(tile, max_zoom, metatile=1, materialize_zooms=None):
@@ -99,7 +212,59 @@ def subpyramids(tile, max_zoom, metatile=1, materialize_zooms=None):
     )
 
 
-def create_archive(tiles, root, max_zoom, meta, ext):
+def estimate_cost(tile, max_zoom, catalog, metatile=1):
+    """Estimate the relative cost of rendering a subpyramid.
+
+    Each tile costs roughly one read per source covering it, so the cost is the
+    number of tiles in the subpyramid weighted by how densely sources cover its
+    root (open ocean is covered by a single low-resolution source, while
+    C-CAP / NLCD areas stack several high-resolution ones).
+    """
+    size = min(metatile, 2 ** tile.z)
+    tiles = sum((size * 2 ** (z - tile.z)) ** 2 for z in range(tile.z, max_zoom + 1))
+
+    density = sum(
+        1 if source.coverage is None else source.coverage
+        for source in upstream_sources_for_tile(
+            tile, catalog, min_zoom=tile.z, max_zoom=max_zoom, size=size
+        )
+    )
+
+    return tiles * (1 + density)
+
+
+def summarizing(format, summaries, block, size=1):
+    """Wrap a format to record class-area summaries of each tile in a block.
+
+    Tiles are located within the rendered pixels using their bounds, since
+    collars are dropped on sides that reach the edge of the world.
+    """
+
+    def _format(pixels, data_format, sources):
+        data = pixels.data[0]
+        height, width = data.shape
+        left, bottom, right, top = pixels.bounds.bounds
+        dx = (right - left) / width
+        dy = (top - bottom) / height
+
+        for tile in block_tiles(block, size):
+            t_left, t_bottom, t_right, t_top = mercantile.xy_bounds(tile)
+            col = int(round((t_left - left) / dx))
+            row = int(round((top - t_top) / dy))
+            col_end = int(round((t_right - left) / dx))
+            row_end = int(round((top - t_bottom) / dy))
+
+            summaries[tile] = class_areas(
+                data[row:row_end, col:col_end],
+                (t_left, t_bottom, t_right, t_top),
+            )
+
+        return format(pixels, data_format, sources)
+
+    return _format
+
+
+def create_archive(tiles, root, max_zoom, meta, ext, summaries=None):
     # expand bounds
     roots = generate_tiles(root, root.z, meta.get("metatile", 1))
 
@@ -123,9 +288,12 @@ def create_archive(tiles, root, max_zoom, meta, ext):
     with ZipFile(out, "w", ZIP_DEFLATED, allowZip64=True) as archive:
         archive.comment = json.dumps(meta).encode("utf-8")
 
-        for tile, (_, data) in tiles:
+        for tile, (_, data), summary in tiles:
             logger.info("%d/%d/%d", tile.z, tile.x, tile.y)
 
+            if summaries is not None and summary is not None:
+                summaries["{}/{}/{}".format(tile.z, tile.x, tile.y)] = summary
+
             info = ZipInfo(
                 "{}/{}/{}@2x.{}".format(tile.z, tile.x, tile.y, ext), date_time
             )
@@ -135,34 +303,6 @@ def create_archive(tiles, root, max_zoom, meta, ext):
     return out.getvalue()
 
 
-def write(body, target):
-    url = urlparse(target)
-
-    if url.scheme in ("", "file"):
-        target = path.abspath(url.netloc + url.path)
-
-        if not path.isdir(path.dirname(target)):
-            makedirs(path.dirname(target))
-
-        if isinstance(body, str):
-            mode = "w"
-        else:
-            mode = "wb"
-
-        with open(target, mode) as out:
-            out.write(body)
-    elif url.scheme == "s3":
-        bucket = url.netloc
-        key = url.path[1:]
-
-        try:
-            S3.put_object(
-                Body=body, Bucket=bucket, Key=key, ContentType="application/zip"
-            )
-        except botocore.exceptions.ClientError as e:
-            logger.exception(e)
-
-
 def power_of_2(value):
     value = int(value)
 
@@ -228,12 +368,58 @@ if __name__ == "__main__":
         default=0,
         help='Buffer size in "pixels" (for GeoJSON output)',
     )
+    parser.add_argument(
+        "--seamless",
+        action="store_true",
+        help="Vectorize each metatile once and clip features to its tiles (for GeoJSON output)",
+    )
+    parser.add_argument(
+        "--summaries",
+        action="store_true",
+        help="Write per-tile class-area summaries alongside archives",
+    )
+    parser.add_argument(
+        "--lease",
+        type=int,
+        default=600,
+        help="Lease duration (in seconds) for subpyramids claimed from a work queue",
+    )
+    parser.add_argument(
+        "--max-attempts",
+        type=int,
+        default=3,
+        help="Number of times to attempt each subpyramid in a work queue",
+    )
+    parser.add_argument(
+        "--journal-mode",
+        choices=["DELETE", "WAL"],
+        default="DELETE",
+        type=str.upper,
+        help="Work queue journal mode (WAL is faster, but only works when every process is on one host)",
+    )
+    queue_mode = parser.add_mutually_exclusive_group()
+    queue_mode.add_argument(
+        "--enqueue",
+        metavar="QUEUE",
+        help="Enqueue materialized subpyramids (most expensive first) into a SQLite work queue instead of rendering them",
+    )
+    queue_mode.add_argument(
+        "--worker",
+        metavar="QUEUE",
+        help="Render materialized subpyramids claimed from a SQLite work queue",
+    )
     parser.add_argument(
         "target", default="file://./", nargs="?", help="Target path/URI for archives"
     )
 
     args = parser.parse_args()
 
+    if args.seamless and args.format != "json":
+        parser.error("--seamless only applies to GeoJSON output")
+
+    if args.seamless and args.metatile == 1:
+        parser.error("--seamless requires --metatile > 1 (it would only add clipping)")
+
     if args.verbose:
         logger.setLevel(logging.DEBUG)
 
@@ -257,6 +443,7 @@ if __name__ == "__main__":
             max_zoom,
         )
         catalog = build_catalog(root, min_zoom, max_zoom)
+        SOURCES = catalog.registry()
     else:
         catalog = CATALOG
 
@@ -264,6 +451,7 @@ if __name__ == "__main__":
     format = GEOTIFF_FORMAT
     formats = {"tif": "image/tiff"}
     transformation = None
+    collar = 0
 
     if args.format == "png":
         ext = "png"
@@ -274,14 +462,27 @@ if __name__ == "__main__":
         ext = "json"
         format = GeoJSON(args.sieve)
         formats = {"json": "application/json"}
-        transformation = Transformation(collar=args.buffer * scale)
+        collar = int(args.buffer * scale)
+        transformation = Transformation(collar=collar)
 
     def render(tile_with_sources):
         tile, sources = tile_with_sources
 
+        if SOURCES is not None:
+            sources = resolve_sources(sources, tile)
+
+        summaries = {}
+        tile_format = format
+        if args.summaries:
+            tile_format = summarizing(format, summaries, tile)
+
         with Timer() as t:
             headers, data = tiling.render_tile_from_sources(
-                tile, sources, format=format, transformation=transformation, scale=scale
+                tile,
+                sources,
+                format=tile_format,
+                transformation=transformation,
+                scale=scale,
             )
 
         logger.debug(
@@ -294,14 +495,73 @@ if __name__ == "__main__":
             headers.get("Server-Timing"),
         )
 
-        return (tile, (headers, data))
+        return (tile, (headers, data), summaries.get(tile))
+
+    def render_block(block_with_sources):
+        (block, size), sources = block_with_sources
+
+        if SOURCES is not None:
+            sources = resolve_sources(sources, block)
+
+        summaries = {}
+        block_format = format
+        if args.summaries:
+            block_format = summarizing(format, summaries, block, size)
+
+        with Timer() as t:
+            # sieve and vectorize the whole block (plus collar) at once
+            headers, data = tiling.render_tile_from_sources(
+                block,
+                sources,
+                format=block_format,
+                transformation=transformation,
+                scale=scale * size,
+            )
+
+            fs = json.loads(data)["features"]
+            tiles = []
+
+            for tile in block_tiles(block, size):
+                west, south, east, north = mercantile.bounds(tile)
+                dx = (east - west) * args.buffer / 256
+                dy = (north - south) * args.buffer / 256
 
-    def sources_for_tile(tile):
+                fc = {
+                    "type": "FeatureCollection",
+                    "features": list(
+                        clip(fs, (west - dx, south - dy, east + dx, north + dy))
+                    ),
+                }
+
+                tiles.append((tile, (headers, json.dumps(fc)), summaries.get(tile)))
+
+        logger.debug(
+            "(%d/%d/%d) Took %.03fs to render %d tiles (%d features), %s",
+            block.z,
+            block.x,
+            block.y,
+            t.elapsed,
+            len(tiles),
+            len(fs),
+            headers.get("Server-Timing"),
+        )
+
+        return tiles
+
+    def sources_for_block(block_with_size):
+        block, size = block_with_size
+
+        return (block_with_size, sources_for_tile(block, size)[1])
+
+    def sources_for_tile(tile, size=1):
         """Render a tile's source footprints."""
         bounds = Bounds(mercantile.xy_bounds(tile), WEB_MERCATOR_CRS)
-        shape = Affine.scale(scale) * (256, 256)
+        shape = Affine.scale(scale * size) * (256, 256)
         resolution = get_resolution_in_meters(bounds, shape)
 
+        if SOURCES is not None:
+            return (tile, tuple(catalog.get_source_ids(bounds, resolution)))
+
         # convert sources to a list to avoid passing the generator across thread boundaries
         return (tile, list(catalog.get_sources(bounds, resolution)))
 
@@ -331,46 +591,172 @@ if __name__ == "__main__":
         root_meta["materializedZooms"] = materialize_zooms
         root_meta["source"] = source
 
+        if args.summaries:
+            root_meta["summaries"] = source[: -len(".zip")] + ".stats.json"
+
         write(json.dumps(root_meta), path.join(args.target, "meta.json"))
 
-    with futures.ProcessPoolExecutor(max_workers=concurrency) as executor:
-        for materialized_tile in subpyramids(
-            root, args.max_zoom, metatile, materialize_zooms
-        ):
-            # find the next materialized zoom
-            idx = bisect_right(materialize_zooms, materialized_tile.z)
-            if idx != len(materialize_zooms):
-                # treat the zoom before the next materialized zoom as the max
-                max_zoom = materialize_zooms[idx] - 1
-            else:
-                # out of materialized zooms
-                max_zoom = args.max_zoom
+    def subpyramid_max_zoom(materialized_tile):
+        # find the next materialized zoom
+        idx = bisect_right(materialize_zooms, materialized_tile.z)
+        if idx != len(materialize_zooms):
+            # treat the zoom before the next materialized zoom as the max
+            return materialize_zooms[idx] - 1
 
-            logger.info(
-                "Rendering %d/%d/%d to zoom %d",
-                materialized_tile.z,
-                materialized_tile.x,
-                materialized_tile.y,
-                max_zoom,
-            )
+        # out of materialized zooms
+        return args.max_zoom
 
-            tiles = executor.map(
+    def render_subpyramid(executor, materialized_tile, max_zoom):
+        logger.info(
+            "Rendering %d/%d/%d to zoom %d",
+            materialized_tile.z,
+            materialized_tile.x,
+            materialized_tile.y,
+            max_zoom,
+        )
+
+        if args.seamless:
+            tiles = itertools.chain.from_iterable(
+                bounded_map(
+                    executor,
+                    render_block,
+                    map(
+                        sources_for_block,
+                        generate_blocks(materialized_tile, max_zoom, metatile),
+                    ),
+                    concurrency * 4,
+                )
+            )
+        else:
+            tiles = bounded_map(
+                executor,
                 render,
                 map(
                     sources_for_tile,
                     generate_tiles(materialized_tile, max_zoom, metatile),
                 ),
+                concurrency * 4,
             )
 
-            archive = create_archive(
-                tiles, materialized_tile, max_zoom, meta.copy(), ext
+        summaries = {} if args.summaries else None
+        archive = create_archive(
+            tiles, materialized_tile, max_zoom, meta.copy(), ext, summaries
+        )
+
+        key = "{}/{}/{}".format(
+            materialized_tile.z, materialized_tile.x, materialized_tile.y
+        )
+        if args.hash:
+            h = hashlib.md5(key.encode("utf-8")).hexdigest()[:5]
+            key = "{}/{}".format(h, key)
+
+        # failed uploads must fail queued subpyramids so that they're retried
+        strict = args.worker is not None
+
+        write(archive, path.join(args.target, "{}.zip".format(key)), strict=strict)
+
+        if summaries is not None:
+            write(
+                json.dumps(summaries),
+                path.join(args.target, "{}.stats.json".format(key)),
+                content_type="application/json",
+                strict=strict,
             )
 
-            key = "{}/{}/{}".format(
-                materialized_tile.z, materialized_tile.x, materialized_tile.y
+    # parameters that affect which subpyramids are rendered and their contents
+    # (which workers must agree on)
+    queue_params = {
+        # workers caching sources do so for the root's pyramid
+        "root": [root.z, root.x, root.y],
+        "max_zoom": args.max_zoom,
+        "cache_sources": args.cache_sources,
+        "target": args.target,
+        "format": args.format,
+        "scale": scale,
+        "metatile": metatile,
+        "materialize": materialize_zooms,
+        "hash": args.hash,
+        "sieve": args.sieve,
+        "buffer": args.buffer,
+        "seamless": args.seamless,
+        "summaries": args.summaries,
+    }
+
+    if args.enqueue:
+        queue = WorkQueue(
+            args.enqueue,
+            lease=args.lease,
+            max_attempts=args.max_attempts,
+            journal_mode=args.journal_mode,
+        )
+        queue.configure(queue_params)
+
+        for materialized_tile in subpyramids(
+            root, args.max_zoom, metatile, materialize_zooms
+        ):
+            max_zoom = subpyramid_max_zoom(materialized_tile)
+            cost = estimate_cost(materialized_tile, max_zoom, CATALOG, metatile)
+
+            logger.info(
+                "Enqueueing %d/%d/%d to zoom %d (cost: %.01f)",
+                materialized_tile.z,
+                materialized_tile.x,
+                materialized_tile.y,
+                max_zoom,
+                cost,
             )
-            if args.hash:
-                h = hashlib.md5(key.encode("utf-8")).hexdigest()[:5]
-                key = "{}/{}".format(h, key)
 
-            write(archive, path.join(args.target, "{}.zip".format(key)))
+            queue.put(materialized_tile, max_zoom, cost)
+    elif args.worker:
+        queue = WorkQueue(
+            args.worker,
+            lease=args.lease,
+            max_attempts=args.max_attempts,
+            journal_mode=args.journal_mode,
+        )
+        queue.configure(queue_params)
+        worker = "{}:{}".format(socket.gethostname(), os.getpid())
+        executor = futures.ProcessPoolExecutor(max_workers=concurrency)
+
+        try:
+            while True:
+                item = queue.claim(worker)
+
+                if item is None:
+                    if queue.remaining() == 0:
+                        break
+
+                    # other workers hold leases; wait in case they expire
+                    time.sleep(min(30, args.lease / 10))
+                    continue
+
+                id, z, x, y, max_zoom = item
+
+                with Heartbeat(queue, id, worker):
+                    try:
+                        render_subpyramid(executor, Tile(x, y, z), max_zoom)
+                    except Exception as e:
+                        logger.exception("Failed to render %d/%d/%d", z, x, y)
+                        queue.fail(id, worker, traceback.format_exc())
+
+                        if isinstance(e, BrokenProcessPool):
+                            # a sub-process died (e.g. OOM); start over with a
+                            # fresh pool rather than failing every later item
+                            executor.shutdown(wait=False)
+                            executor = futures.ProcessPoolExecutor(
+                                max_workers=concurrency
+                            )
+                    else:
+                        queue.complete(id, worker)
+        finally:
+            executor.shutdown()
+
+        logger.info("Work queue drained: %s", queue.counts())
+    else:
+        with futures.ProcessPoolExecutor(max_workers=concurrency) as executor:
+            for materialized_tile in subpyramids(
+                root, args.max_zoom, metatile, materialize_zooms
+            ):
+                render_subpyramid(
+                    executor, materialized_tile, subpyramid_max_zoom(materialized_tile)
+                )
@@ -0,0 +1,33 @@
+# coding=utf-8
+from __future__ import print_function
+
+import argparse
+import logging
+from os import path, remove
+
+from ..catalogs import SpatialiteCatalog
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+# E.g. python3 -m landcover.tools.snapshot catalog/land_cover.sql.gz catalog/land_cover.sqlite3
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dump", help="pg_dump of the land_cover table")
+    parser.add_argument("target", help="Spatialite snapshot to write")
+    parser.add_argument(
+        "--table", "-t", default="land_cover", help="Table name within the dump"
+    )
+
+    args = parser.parse_args()
+
+    catalog = SpatialiteCatalog()
+    catalog.load_dump(args.dump, table=args.table)
+
+    if path.exists(args.target):
+        remove(args.target)
+
+    catalog.save(args.target)
+
+    logger.info("Wrote %s", args.target)
@@ -0,0 +1,240 @@
+# coding=utf-8
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class WorkQueue(object):
+    """A durable, SQLite-backed queue of materialized subpyramids.
+
+    Items are claimed with leases; a claimed item whose lease expires (because
+    its worker died or stopped heart-beating) becomes claimable again until it
+    has been attempted `max_attempts` times.
+
+    Any number of processes may share a queue. Processes on different hosts
+    can share it on a network filesystem with working POSIX (fcntl) locks,
+    using the default rollback journal (`journal_mode="DELETE"`). WAL
+    (`journal_mode="WAL"`) is faster but relies on shared memory, so it only
+    works when every process runs on the same host.
+    """
+
+    def __init__(self, path, lease=600, max_attempts=3, journal_mode="DELETE"):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.journal_mode = journal_mode
+        self.conn = self._connect()
+
+        self.conn.executescript(
+            """
+CREATE TABLE IF NOT EXISTS subpyramids (
+  id integer PRIMARY KEY,
+  z integer NOT NULL,
+  x integer NOT NULL,
+  y integer NOT NULL,
+  max_zoom integer NOT NULL,
+  cost double precision NOT NULL,
+  status text NOT NULL DEFAULT 'pending',
+  attempts integer NOT NULL DEFAULT 0,
+  worker text,
+  lease_expires_at double precision,
+  error text,
+  UNIQUE (z, x, y)
+);
+CREATE INDEX IF NOT EXISTS subpyramids_claim_idx ON subpyramids (status, cost);
+CREATE TABLE IF NOT EXISTS params (
+  id integer PRIMARY KEY CHECK (id = 1),
+  params text NOT NULL
+);
+      """
+        )
+
+    def _connect(self):
+        # autocommit; transactions are managed explicitly where they matter
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        conn.execute("PRAGMA journal_mode={}".format(self.journal_mode))
+
+        return conn
+
+    def configure(self, params):
+        """Record the parameters items are rendered with, or check them against those already recorded.
+
+        Workers rendering with different parameters would otherwise write
+        inconsistent archives.
+        """
+        params = json.loads(json.dumps(params))
+        cursor = self.conn.cursor()
+
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            row = cursor.execute("SELECT params FROM params").fetchone()
+
+            if row is None:
+                cursor.execute(
+                    "INSERT INTO params (id, params) VALUES (1, ?)",
+                    (json.dumps(params, sort_keys=True),),
+                )
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        finally:
+            cursor.close()
+
+        if row is not None and json.loads(row[0]) != params:
+            raise Exception(
+                "Parameters don't match those the queue was created with: {} != {}".format(
+                    json.dumps(params, sort_keys=True), row[0]
+                )
+            )
+
+    def put(self, tile, max_zoom, cost):
+        self.conn.execute(
+            """
+INSERT OR IGNORE INTO subpyramids (z, x, y, max_zoom, cost)
+VALUES (?, ?, ?, ?, ?)
+      """,
+            (tile.z, tile.x, tile.y, max_zoom, cost),
+        )
+
+    def claim(self, worker):
+        """Claim the most expensive available item, returning (id, z, x, y, max_zoom)."""
+        now = time.time()
+        cursor = self.conn.cursor()
+
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            # give up on items whose last lease expired
+            cursor.execute(
+                """
+UPDATE subpyramids
+SET status = 'failed',
+    lease_expires_at = NULL,
+    error = coalesce(error, 'Lease expired')
+WHERE status = 'running' AND lease_expires_at < ? AND attempts >= ?
+      """,
+                (now, self.max_attempts),
+            )
+            cursor.execute(
+                """
+SELECT id, z, x, y, max_zoom
+FROM subpyramids
+WHERE (status = 'pending' OR (status = 'running' AND lease_expires_at < ?))
+  AND attempts < ?
+ORDER BY cost DESC
+LIMIT 1
+      """,
+                (now, self.max_attempts),
+            )
+            item = cursor.fetchone()
+
+            if item is not None:
+                cursor.execute(
+                    """
+UPDATE subpyramids
+SET status = 'running',
+    worker = ?,
+    attempts = attempts + 1,
+    lease_expires_at = ?
+WHERE id = ?
+      """,
+                    (worker, now + self.lease, item[0]),
+                )
+
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        finally:
+            cursor.close()
+
+        return item
+
+    def heartbeat(self, id, worker, conn=None):
+        (conn or self.conn).execute(
+            """
+UPDATE subpyramids
+SET lease_expires_at = ?
+WHERE id = ? AND worker = ? AND status = 'running'
+      """,
+            (time.time() + self.lease, id, worker),
+        )
+
+    def complete(self, id, worker):
+        self.conn.execute(
+            """
+UPDATE subpyramids
+SET status = 'done', lease_expires_at = NULL, error = NULL
+WHERE id = ? AND worker = ?
+      """,
+            (id, worker),
+        )
+
+    def fail(self, id, worker, error):
+        """Release an item for retry (or mark it failed once out of attempts)."""
+        self.conn.execute(
+            """
+UPDATE subpyramids
+SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END,
+    lease_expires_at = NULL,
+    error = ?
+WHERE id = ? AND worker = ?
+      """,
+            (self.max_attempts, error, id, worker),
+        )
+
+    def remaining(self):
+        """Count items that have yet to be completed (or given up on).
+
+        (Running items whose last lease has expired are given up on by claim.)
+        """
+        return self.conn.execute(
+            """
+SELECT count(*)
+FROM subpyramids
+WHERE status IN ('pending', 'running')
+      """
+        ).fetchone()[0]
+
+    def counts(self):
+        return dict(
+            self.conn.execute(
+                "SELECT status, count(*) FROM subpyramids GROUP BY status"
+            ).fetchall()
+        )
+
+
+class Heartbeat(threading.Thread):
+    """Periodically extend the lease on a claimed item while it's being rendered."""
+
+    def __init__(self, queue, id, worker):
+        super(Heartbeat, self).__init__(daemon=True)
+        self.queue = queue
+        self.id = id
+        self.worker = worker
+        self.stopped = threading.Event()
+
+    def run(self):
+        # sqlite3 connections can't be shared across threads
+        conn = self.queue._connect()
+
+        try:
+            while not self.stopped.wait(self.queue.lease / 3):
+                try:
+                    self.queue.heartbeat(self.id, self.worker, conn=conn)
+                except sqlite3.Error as e:
+                    logger.warning("Heartbeat for %d failed: %s", self.id, e)
+        finally:
+            conn.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.join()
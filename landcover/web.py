@@ -1,12 +1,18 @@
 # coding=utf-8
 from __future__ import absolute_import
 
+import json
 import logging
+import os
+import resource
+import threading
+import uuid
+from datetime import datetime
 from urllib.parse import urlencode
 from logging import StreamHandler
 
 from cachetools.func import lru_cache
-from flask import Flask, Markup, jsonify, render_template, request
+from flask import Flask, Markup, abort, jsonify, render_template, request
 from marblecutter import NoCatalogAvailable, tiling
 from marblecutter.catalogs.postgis import PostGISCatalog
 from marblecutter.formats.geotiff import GeoTIFF
@@ -16,15 +22,52 @@ from marblecutter.web import bp, url_for
 from mercantile import Tile
 
 from .colormap import COLORMAP
-from .formats import GeoJSON
+from .concurrency import Overloaded, RenderPool, SingleFlight
+from .export import export
+from .formats import GeoJSON, Summary
+from .lookup import lookup
+from .metrics import gdal_cache, io_counters
+from .recipes import install as install_recipes
+from .stats import Summaries, area_stats, validate
+from .storage import read, write
 
 LOG = logging.getLogger(__name__)
-CATALOG = PostGISCatalog(table="land_cover")
+if "CATALOG_PATH" in os.environ:
+    # embedded catalog (requires pysqlite3 and mod_spatialite)
+    from .catalogs import FileCatalog
+
+    CATALOG = FileCatalog(
+        os.environ["CATALOG_PATH"],
+        check_interval=int(os.environ.get("CATALOG_CHECK_INTERVAL", 60)),
+        source_root=os.environ.get("SOURCE_ROOT"),
+    )
+else:
+    CATALOG = PostGISCatalog(table="land_cover")
 COLORMAP_TRANSFORMATION = Colormap(COLORMAP)
 IMAGE_TRANSFORMATION = Image()
 IMAGE_FORMAT = PNG(paletted=True)
 GEOTIFF_FORMAT = GeoTIFF(colormap=COLORMAP)
 
+RENDER_THREADS = int(os.environ.get("RENDER_THREADS", os.cpu_count()))
+RENDER_POOL = RenderPool(
+    RENDER_THREADS, int(os.environ.get("RENDER_QUEUE_DEPTH", RENDER_THREADS * 4))
+)
+SINGLE_FLIGHT = SingleFlight()
+STATS_MAX_TILES = int(os.environ.get("STATS_MAX_TILES", 256))
+STATS_MAX_RENDERS = int(os.environ.get("STATS_MAX_RENDERS", 64))
+STATS_CONCURRENCY = int(os.environ.get("STATS_CONCURRENCY", RENDER_THREADS))
+LOOKUP_MAX_POINTS = int(os.environ.get("LOOKUP_MAX_POINTS", 10000))
+LOOKUP_ZOOM = int(os.environ.get("LOOKUP_ZOOM", 12))
+EXPORT_POOL = RenderPool(
+    int(os.environ.get("EXPORT_THREADS", 1)),
+    int(os.environ.get("EXPORT_QUEUE_DEPTH", 4)),
+)
+EXPORT_CONCURRENCY = int(os.environ.get("EXPORT_CONCURRENCY", 4))
+EXPORT_MAX_PIXELS = int(os.environ.get("EXPORT_MAX_PIXELS", 10 ** 9))
+ENABLE_METRICS = os.environ.get("ENABLE_METRICS", "").lower() in ("1", "true", "yes")
+
+install_recipes()
+
 # configure logging
 
 logging.basicConfig(level=logging.INFO)
@@ -36,6 +79,63 @@ app.register_blueprint(bp)
 app.url_map.strict_slashes = False
 
 
+def render_tile(tile, **kwargs):
+    """Render a tile off the event loop, sharing the result with identical concurrent requests."""
+    headers, data = SINGLE_FLIGHT.do(
+        request.full_path,
+        RENDER_POOL.apply,
+        tiling.render_tile,
+        tile,
+        CATALOG,
+        **kwargs
+    )
+
+    headers = dict(headers)
+    headers.update(CATALOG.headers)
+
+    return headers, data
+
+
+@lru_cache()
+def get_summaries():
+    if "SUMMARIES_URL" not in os.environ:
+        return None
+
+    return Summaries(os.environ["SUMMARIES_URL"])
+
+
+@app.errorhandler(Overloaded)
+def overloaded(e):
+    LOG.warning("Shedding load: %s", e)
+
+    return "Service Unavailable", 503, {"Retry-After": "1"}
+
+
+@app.route("/metrics")
+def metrics():
+    """Per-worker counters, used by landcover.tools.loadtest."""
+    if not ENABLE_METRICS:
+        abort(404)
+
+    metrics = {
+        "pid": os.getpid(),
+        # kilobytes on Linux
+        "maxrss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "single_flight": {"hits": SINGLE_FLIGHT.hits, "misses": SINGLE_FLIGHT.misses},
+        "render_pool": {
+            "pending": RENDER_POOL.pending,
+            "rejected": RENDER_POOL.rejected,
+        },
+        "gdal_cache": gdal_cache(),
+        "io": io_counters(),
+    }
+
+    if hasattr(CATALOG, "hits"):
+        metrics["catalog"] = {"hits": CATALOG.hits, "misses": CATALOG.misses}
+
+    return jsonify(metrics)
+
+
 @app.route("/")
 def meta():
     meta = {
@@ -74,16 +174,13 @@ def preview():
 def render_png(z, x, y, scale=1):
     tile = Tile(x, y, z)
 
-    headers, data = tiling.render_tile(
+    headers, data = render_tile(
         tile,
-        CATALOG,
         format=IMAGE_FORMAT,
         transformation=COLORMAP_TRANSFORMATION,
         scale=scale,
     )
 
-    headers.update(CATALOG.headers)
-
     return data, 200, headers
 
 
@@ -95,16 +192,13 @@ def render_json(z, x, y, scale=1):
 
     sieve = int(request.args.get("sieve", 4))
 
-    headers, data = tiling.render_tile(
+    headers, data = render_tile(
         tile,
-        CATALOG,
         format=GeoJSON(sieve_size=sieve),
         transformation=Transformation(collar=8 * scale),
         scale=scale,
     )
 
-    headers.update(CATALOG.headers)
-
     return data, 200, headers
 
 
@@ -112,9 +206,7 @@ def render_json(z, x, y, scale=1):
 def render_tif(z, x, y):
     tile = Tile(x, y, z)
 
-    headers, data = tiling.render_tile(tile, CATALOG, format=GEOTIFF_FORMAT)
-
-    headers.update(CATALOG.headers)
+    headers, data = render_tile(tile, format=GEOTIFF_FORMAT)
 
     return data, 200, headers
 
@@ -157,17 +249,14 @@ def raw_preview():
 def raw_render_png(z, x, y, scale=1):
     tile = Tile(x, y, z)
 
-    headers, data = tiling.render_tile(
+    headers, data = render_tile(
         tile,
-        CATALOG,
         format=IMAGE_FORMAT,
         transformation=IMAGE_TRANSFORMATION,
         expand="meta",
         scale=scale,
     )
 
-    headers.update(CATALOG.headers)
-
     return data, 200, headers
 
 
@@ -175,10 +264,182 @@ def raw_render_png(z, x, y, scale=1):
 def raw_render_tif(z, x, y):
     tile = Tile(x, y, z)
 
-    headers, data = tiling.render_tile(
-        tile, CATALOG, format=GEOTIFF_FORMAT, expand="meta"
+    headers, data = render_tile(tile, format=GEOTIFF_FORMAT, expand="meta")
+
+    return data, 200, headers
+
+
+@app.route("/stats", methods=["GET", "POST"])
+def stats():
+    if request.method == "POST":
+        geometry = request.get_json(force=True, silent=True)
+
+        if isinstance(geometry, dict) and geometry.get("type") == "Feature":
+            geometry = geometry.get("geometry")
+    else:
+        try:
+            west, south, east, north = map(float, request.args["bbox"].split(","))
+        except (KeyError, ValueError):
+            abort(400, "bbox=<west>,<south>,<east>,<north> is required")
+
+        geometry = {
+            "type": "Polygon",
+            "coordinates": [
+                [[west, south], [west, north], [east, north], [east, south], [west, south]]
+            ],
+        }
+
+    try:
+        validate(geometry)
+    except ValueError as e:
+        abort(400, str(e))
+
+    def render(tile, geometry):
+        _, data = RENDER_POOL.apply(
+            tiling.render_tile, tile, CATALOG, format=Summary(geometry)
+        )
+
+        return {int(k): v for k, v in json.loads(data).items()}
+
+    return jsonify(
+        area_stats(
+            geometry,
+            render,
+            summaries=get_summaries(),
+            min_zoom=CATALOG.minzoom,
+            max_zoom=CATALOG.maxzoom,
+            max_tiles=STATS_MAX_TILES,
+            max_renders=STATS_MAX_RENDERS,
+            concurrency=STATS_CONCURRENCY,
+        )
     )
 
-    headers.update(CATALOG.headers)
 
-    return data, 200, headers
+@app.route("/lookup", methods=["POST"])
+def lookup_points():
+    body = request.get_json(force=True, silent=True)
+
+    if not isinstance(body, dict):
+        abort(400, 'A {"points": [[<lon>, <lat>], ...]} object or MultiPoint is required')
+
+    if body.get("type") == "MultiPoint":
+        points = body.get("coordinates")
+    else:
+        points = body.get("points")
+
+    try:
+        points = [(float(p[0]), float(p[1])) for p in points]
+    except (IndexError, TypeError, ValueError):
+        abort(400, "A list of [<lon>, <lat>] points is required")
+
+    if not all(-180 <= lon <= 180 and -90 <= lat <= 90 for lon, lat in points):
+        abort(400, "Points must be within [-180, -90, 180, 90]")
+
+    if len(points) > LOOKUP_MAX_POINTS:
+        abort(400, "At most {} points may be looked up at once".format(LOOKUP_MAX_POINTS))
+
+    try:
+        zoom = int(request.args.get("zoom", LOOKUP_ZOOM))
+    except ValueError:
+        abort(400, "zoom must be an integer")
+
+    zoom = max(CATALOG.minzoom, min(CATALOG.maxzoom, zoom))
+
+    return jsonify(RENDER_POOL.apply(lookup, CATALOG, points, zoom))
+
+
+def export_url(id, ext):
+    return "{}/{}.{}".format(os.environ["EXPORT_TARGET"].rstrip("/"), id, ext)
+
+
+def now():
+    return datetime.utcnow().isoformat() + "Z"
+
+
+def run_export(job, bbox, crs, resolution, zoom):
+    def _export():
+        # only running once the pool has a slot for it
+        job["status"] = "running"
+        job["started_at"] = now()
+        write(json.dumps(job), export_url(job["id"], "json"), "application/json")
+
+        export(
+            CATALOG,
+            bbox,
+            job["url"],
+            crs=crs,
+            resolution=resolution,
+            zoom=zoom,
+            concurrency=EXPORT_CONCURRENCY,
+            max_pixels=EXPORT_MAX_PIXELS,
+        )
+
+    try:
+        # the slot was reserved when the job was accepted
+        EXPORT_POOL.apply_reserved(_export)
+        job["status"] = "complete"
+    except Exception as e:
+        LOG.exception(e)
+        job["status"] = "failed"
+        job["error"] = str(e)
+
+    job["finished_at"] = now()
+    write(json.dumps(job), export_url(job["id"], "json"), "application/json")
+
+
+@app.route("/exports", methods=["POST"])
+def create_export():
+    if "EXPORT_TARGET" not in os.environ:
+        abort(404)
+
+    body = request.get_json(force=True, silent=True) or {}
+
+    try:
+        bbox = [float(x) for x in body["bbox"]]
+        assert len(bbox) == 4
+    except (AssertionError, KeyError, TypeError, ValueError):
+        abort(400, "bbox ([<west>, <south>, <east>, <north>]) is required")
+
+    zoom = body.get("zoom")
+    resolution = body.get("resolution")
+
+    if zoom is None and resolution is None:
+        abort(400, "Either zoom or resolution is required")
+
+    # reserve a slot now so that excess jobs are rejected (503) rather than
+    # accepted and then failed
+    EXPORT_POOL.reserve()
+
+    id = uuid.uuid4().hex
+    job = {
+        "id": id,
+        "status": "pending",
+        "url": export_url(id, "tif"),
+        "created_at": now(),
+    }
+
+    try:
+        write(json.dumps(job), export_url(id, "json"), "application/json")
+
+        # the export itself runs on the export pool; this just waits on it
+        threading.Thread(
+            target=run_export,
+            args=(job.copy(), bbox, body.get("crs", "EPSG:3857"), resolution, zoom),
+            daemon=True,
+        ).start()
+    except Exception:
+        EXPORT_POOL.release()
+        raise
+
+    return jsonify(job), 202, {"Location": url_for("export_status", id=id)}
+
+
+@app.route("/exports/<id>")
+def export_status(id):
+    if "EXPORT_TARGET" not in os.environ:
+        abort(404)
+
+    try:
+        return jsonify(json.loads(read(export_url(id, "json")).decode("utf-8")))
+    except Exception:
+        abort(404)